@@ -0,0 +1,54 @@
+# measure event dispatch throughput through CassBotCore's watch wrappers
+#
+# usage: python bench/bench_dispatch.py [path-to-cassbot-tree]
+#
+# Give the path of another checkout (say, from git worktree) to compare
+# before and after a change. Three plugins watch privmsg, two watch
+# userJoined; the two events alternate.
+
+import os
+import sys
+import tempfile
+import time
+
+tree = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.abspath(tree))
+
+import cassbot
+
+class P1(cassbot.BaseBotPlugin):
+    def privmsg(self, bot, user, channel, msg):
+        pass
+    def userJoined(self, bot, user, chan):
+        pass
+
+class P2(cassbot.BaseBotPlugin):
+    def privmsg(self, bot, user, channel, msg):
+        pass
+
+class P3(cassbot.BaseBotPlugin):
+    def privmsg(self, bot, user, channel, msg):
+        pass
+    def userJoined(self, bot, user, chan):
+        pass
+
+def main(n=200000):
+    statedir = tempfile.mkdtemp()
+    serv = cassbot.CassBotService('tcp:host=localhost:port=6667', nickname='bot',
+                                  statefile=os.path.join(statedir, 'bench.state.db'))
+    serv.get_plugin_classes = lambda: [P1, P2, P3]
+    for pclass in (P1, P2, P3):
+        serv.enable_plugin_by_name(pclass.name())
+    bot = cassbot.CassBotCore('bot')
+    serv.initialize_proto_state(bot)
+    start = time.time()
+    for i in xrange(n):
+        bot.privmsg('someone!u@h', '#chan', 'hello there everyone')
+        bot.userJoined('nick%d' % (i % 100), '#chan')
+    elapsed = time.time() - start
+    print '%s: %d events/sec' % (os.path.abspath(tree), 2 * n / elapsed)
+
+if __name__ == '__main__':
+    main()
+
+# vim: set et sw=4 ts=4 :
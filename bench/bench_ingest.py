@@ -0,0 +1,112 @@
+# measure raw line ingest through CassBotCore.lineReceived, and command
+# tokenizing
+#
+# usage: python bench/bench_ingest.py [path-to-cassbot-tree]
+#
+# The corpus is mostly channel chatter, with some CTCP actions, commands,
+# joins, parts and server numerics. Give the path of another checkout to
+# compare before and after a change. Lines whose handling raised (and got
+# logged by Twisted) are counted and reported next to the rate, with their
+# tracebacks kept off the terminal, since they cut the work short.
+
+import os
+import random
+import shlex
+import sys
+import tempfile
+import time
+
+tree = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.abspath(tree))
+
+import cassbot
+from twisted.python import log
+from twisted.test import proto_helpers
+
+words = ('the build is broken again can someone look at CASSANDRA-1234 compaction '
+         'thanks ok lol yes no i think that repair node ring token hint "quoted thing" '
+         "it's don't wait").split(' ')
+
+def make_corpus(n=20000, seed=11):
+    rand = random.Random(seed)
+    corpus = []
+    for i in xrange(n):
+        r = rand.random()
+        nick = 'user%d' % rand.randint(0, 300)
+        pre = ':%s!~%s@host-%d.example.net ' % (nick, nick, rand.randint(0, 50))
+        text = ' '.join(rand.choice(words) for _ in xrange(rand.randint(1, 18)))
+        if r < 0.80:
+            corpus.append(pre + 'PRIVMSG #cassandra :' + text)
+        elif r < 0.85:
+            corpus.append(pre + 'PRIVMSG #cassandra :\x01ACTION ' + text + '\x01')
+        elif r < 0.90:
+            corpus.append(pre + 'PRIVMSG #cassandra :!' + text)
+        elif r < 0.93:
+            corpus.append(pre + 'JOIN #cassandra')
+        elif r < 0.96:
+            corpus.append(pre + 'PART #cassandra :bye')
+        else:
+            corpus.append(':irc.example.net 372 bot :- motd line')
+    return corpus
+
+class Listener(cassbot.BaseBotPlugin):
+    def privmsg(self, bot, user, channel, msg):
+        pass
+
+class ErrorCounter:
+    def __init__(self):
+        self.errors = 0
+
+    def __call__(self, event):
+        if event.get('isError'):
+            self.errors += 1
+
+def main():
+    corpus = make_corpus()
+    counter = ErrorCounter()
+    log.startLoggingWithObserver(counter, setStdout=False)
+    statedir = tempfile.mkdtemp()
+    serv = cassbot.CassBotService('tcp:host=localhost:port=6667', nickname='bot',
+                                  statefile=os.path.join(statedir, 'bench.state.db'))
+    serv.get_plugin_classes = lambda: [Listener]
+    serv.enable_plugin_by_name(Listener.name())
+    bot = cassbot.CassBotCore('bot')
+    serv.initialize_proto_state(bot)
+    bot.makeConnection(proto_helpers.StringTransport())
+    bot.nickname = 'bot'
+    bot.cmd_prefix = '!'
+    # measure parsing and dispatch, not command lookup and replies
+    bot.dispatch_command = lambda *a: None
+    for line in corpus[:2000]:
+        bot.lineReceived(line)
+    best = None
+    for rep in xrange(5):
+        counter.errors = 0
+        start = time.time()
+        for line in corpus:
+            bot.lineReceived(line)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print '%s: ingest %.0f lines/sec, %d of %d lines raised' \
+          % (os.path.abspath(tree), len(corpus) / best, counter.errors, len(corpus))
+
+    commands = [line.split(' :', 1)[1][1:] for line in corpus if ' :!' in line] * 10
+    tokenizers = [('shlex.split', shlex.split)]
+    if hasattr(cassbot, 'split_command'):
+        tokenizers.append(('split_command', cassbot.split_command))
+    for name, tokenize in tokenizers:
+        errors = 0
+        start = time.time()
+        for command in commands:
+            try:
+                tokenize(command)
+            except ValueError:
+                errors += 1
+        elapsed = time.time() - start
+        print '  %-13s %.1f us/command, %d of %d raised' \
+              % (name, elapsed / len(commands) * 1e6, errors, len(commands))
+
+if __name__ == '__main__':
+    main()
+
+# vim: set et sw=4 ts=4 :
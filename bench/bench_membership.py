@@ -0,0 +1,70 @@
+# measure how much memory channel membership tracking takes for a large
+# network
+#
+# usage: python bench/bench_membership.py [path-to-cassbot-tree]
+#
+# 50000 users spread over 200 channels, each user in 1 to 8 of them, with
+# about one membership in ten carrying +o or +v. The state is built the way
+# a real connection builds it, by feeding JOIN and NAMES replies through
+# CassBotCore.lineReceived, so any checkout can be measured. Memory is the
+# growth in resident size while building it (Linux only).
+
+import gc
+import os
+import random
+import sys
+import tempfile
+
+tree = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.abspath(tree))
+
+import cassbot
+from twisted.test import proto_helpers
+
+def rss():
+    gc.collect()
+    return int(open('/proc/self/statm').read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def make_names(nusers=50000, nchans=200, seed=7):
+    rand = random.Random(seed)
+    names = dict(('#chan%03d' % c, []) for c in xrange(nchans))
+    for u in xrange(nusers):
+        for c in rand.sample(xrange(nchans), rand.randint(1, 8)):
+            r = rand.random()
+            prefix = '@' if r < 0.03 else '+' if r < 0.1 else ''
+            names['#chan%03d' % c].append('%suser%05d' % (prefix, u))
+    return names
+
+def main():
+    names = make_names()
+    lines = []
+    for chan in sorted(names):
+        lines.append(':bot!b@bot.example.net JOIN %s' % chan)
+        nicks = names[chan]
+        for i in xrange(0, len(nicks), 50):
+            lines.append(':irc.example.net 353 bot = %s :%s'
+                         % (chan, ' '.join(nicks[i:i + 50])))
+        lines.append(':irc.example.net 366 bot %s :End of /NAMES list.' % chan)
+    memberships = sum(len(nicks) for nicks in names.itervalues())
+    users = len(set(nick.lstrip('@+') for nicks in names.itervalues() for nick in nicks))
+
+    statedir = tempfile.mkdtemp()
+    serv = cassbot.CassBotService('tcp:host=localhost:port=6667', nickname='bot',
+                                  statefile=os.path.join(statedir, 'bench.state.db'))
+    bot = cassbot.CassBotCore('bot')
+    serv.initialize_proto_state(bot)
+    bot.makeConnection(proto_helpers.StringTransport())
+    bot.nickname = 'bot'
+
+    base = rss()
+    for line in lines:
+        bot.lineReceived(line)
+    used = rss() - base
+    print '%s: %d users, %d channels, %d memberships: %.1f MB (%.0f bytes/membership)' \
+          % (os.path.abspath(tree), users, len(names), memberships,
+             used / 1048576.0, float(used) / memberships)
+
+if __name__ == '__main__':
+    main()
+
+# vim: set et sw=4 ts=4 :
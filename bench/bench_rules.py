@@ -0,0 +1,98 @@
+# compare RegexResponder's RuleEngine with running every rule's regex in
+# turn, and check that both give the same responses
+#
+# usage: python bench/bench_rules.py [path-to-cassbot-tree]
+
+import os
+import random
+import re
+import sys
+import time
+from string import Template
+
+tree = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, os.path.abspath(tree))
+
+from cassbot_plugins.regex_responder import RuleEngine, required_literal
+try:
+    from ruleworker import ResponseTemplate
+except ImportError:
+    # before rules carried pre-parsed templates
+    ResponseTemplate = None
+
+words = ('the build is broken again can someone look at compaction thanks ok lol yes '
+         'no repair node ring token hint').split()
+
+def make_rules(n=1000, seed=2):
+    """
+    Mostly rules with a long literal (ticket links, wiki words), and one in
+    ten with too short a literal to be prefiltered.
+    """
+    rand = random.Random(seed)
+    projects = ['PROJ%d' % i for i in xrange(n)]
+    rules = []
+    for i in xrange(n):
+        k = i % 10
+        if k < 6:
+            rules.append((r'\b%s-(?P<n>\d+)\b' % projects[i],
+                          'https://issues.example.org/browse/%s-$n' % projects[i]))
+        elif k < 9:
+            rules.append((r'\b(?P<w>%s%d)s?\b' % (rand.choice(words), i), 'see wiki/$w'))
+        else:
+            rules.append((r'\br(?P<n>\d{4,})\b', 'revision $n'))
+    return [(re.compile(pattern), response) for (pattern, response) in rules], projects
+
+def make_messages(projects, n=2000, seed=2):
+    rand = random.Random(seed)
+    msgs = []
+    for i in xrange(n):
+        msg = ' '.join(rand.choice(words) for _ in xrange(rand.randint(3, 20)))
+        r = rand.random()
+        if r < 0.05:
+            msg += ' %s-%d' % (rand.choice(projects), rand.randint(1, 9999))
+        elif r < 0.08:
+            msg += ' r%d' % rand.randint(1000, 99999)
+        elif r < 0.10:
+            msg += ' %s%d' % (rand.choice(words), rand.randrange(1000))
+        msgs.append(msg)
+    msgs.append('PROJ12-5 PROJ1-3 PROJ123-7 and PROJ12-5')
+    return msgs
+
+def every_rule(rules, msg):
+    return [Template(response).safe_substitute(m.groupdict())
+            for (regex, response) in rules for m in regex.finditer(msg)]
+
+def engine_for(rules):
+    if ResponseTemplate is not None:
+        rules = [(regex, ResponseTemplate(response)) for (regex, response) in rules]
+    return RuleEngine(rules)
+
+def per_message(f, msgs):
+    start = time.time()
+    for msg in msgs:
+        f(msg)
+    return (time.time() - start) / len(msgs) * 1e6
+
+def main():
+    rules, projects = make_rules()
+    msgs = make_messages(projects)
+    engine = engine_for(rules)
+    mismatches = sum(1 for msg in msgs
+                     if list(engine.responses(msg)) != every_rule(rules, msg))
+    print '%d rules, %d without a usable literal; %d mismatches over %d messages' \
+          % (len(rules), len(engine.unfiltered), mismatches, len(msgs))
+    print '  every rule:  %.1f us/message' % per_message(lambda m: every_rule(rules, m), msgs)
+    print '  rule engine: %.1f us/message' % per_message(lambda m: list(engine.responses(m)), msgs)
+
+    literal_rules = [rule for rule in rules
+                     if len(required_literal(rule[0])) >= RuleEngine.min_literal]
+    engine = engine_for(literal_rules)
+    print '%d rules, all with literals' % len(literal_rules)
+    print '  every rule:  %.1f us/message' \
+          % per_message(lambda m: every_rule(literal_rules, m), msgs)
+    print '  rule engine: %.1f us/message' % per_message(lambda m: list(engine.responses(m)), msgs)
+
+if __name__ == '__main__':
+    main()
+
+# vim: set et sw=4 ts=4 :
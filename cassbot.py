@@ -2,18 +2,23 @@
 
 from __future__ import with_statement
 
+import os
+import re
 import time
-import shlex
 from functools import wraps
 from itertools import imap, izip
 from fnmatch import fnmatch
 from twisted.words.protocols import irc
-from twisted.internet import defer, protocol, endpoints, task
-from twisted.python import log
+from twisted.internet import defer, protocol, endpoints, task, threads
+from twisted.python import failure, log
 from twisted.plugin import getPlugins, IPlugin
 from twisted.application import internet, service
 from zope.interface import Interface, implements, directlyProvides
 import cassbot_plugins
+from outbound import (OutboundQueue, MoreBuffer, PRIORITY_COMMAND,
+                      PRIORITY_PASSIVE, split_message, pack_lines)
+from membership import ChannelMembership, SplitBatch, netsplit_servers
+from statestore import atomic_write, StateJournal, StateSection, KeyValueDB
 
 try:
     import cPickle as pickle
@@ -80,6 +85,20 @@ class IBotPluginInstance(Interface):
         and args is a list of the words which followed the command.
         """
 
+    def messageFilters():
+        """
+        Return None to get every privmsg and action event this plugin is
+        interested in (the default), or a list of literal strings and
+        compiled regexes: then the plugin's privmsg and action methods are
+        only called for messages containing one of the strings or matching
+        one of the regexes. These should be cheap, and may match more than
+        the plugin really wants, but never less.
+
+        This is called when the plugin is enabled; a plugin whose filters
+        change later should call bot.service.update_message_filters with
+        its name.
+        """
+
     def saveState():
         """
         Return some pickleable object which contains all the configuration
@@ -89,6 +108,10 @@ class IBotPluginInstance(Interface):
         the loadState() call.
 
         If None is returned, no state will be saved for this plugin.
+
+        This may be called at any time while the plugin is loaded, and the
+        returned object may be pickled in another thread afterwards, so it
+        should not share any mutable parts with the live plugin.
         """
 
     def loadState(state):
@@ -104,6 +127,21 @@ class IBotPluginInstance(Interface):
         state info be available.
         """
 
+    def migrateState(state, version):
+        """
+        Convert a state object saved when the plugin's state_version
+        attribute was 'version' to the plugin's current format, and return
+        it. Called before loadState when the versions differ.
+        """
+
+    def teardown():
+        """
+        Called when the plugin is disabled (which includes being reloaded),
+        after its state has been saved. Release anything which would
+        otherwise outlive the plugin object: timers, child processes,
+        connections.
+        """
+
 class BaseBotPlugin_meta(type):
     def __new__(cls, name, bases, attrs):
         newcls = super(BaseBotPlugin_meta, cls).__new__(cls, name, bases, attrs)
@@ -115,6 +153,18 @@ class BaseBotPlugin(object):
     implements(IBotPluginInstance)
     __metaclass__ = BaseBotPlugin_meta
 
+    # a statestore.PluginStore for this plugin's records, set by the service
+    # before loadState is called
+    store = None
+
+    # bump this when changing what saveState returns, and handle the old
+    # format(s) in migrateState
+    state_version = 1
+
+    # during a netsplit, plugins get one netsplit or netjoin event instead
+    # of a userQuit or userJoined for each user. set this to get both.
+    netsplit_user_events = False
+
     def __init__(self):
         if self.__class__ is BaseBotPlugin:
             # keep this one virtual
@@ -166,6 +216,15 @@ class BaseBotPlugin(object):
     def loadState(self, s):
         pass
 
+    def migrateState(self, state, version):
+        return state
+
+    def messageFilters(self):
+        return None
+
+    def teardown(self):
+        pass
+
 
 def noop(*a, **kw):
     pass
@@ -192,6 +251,8 @@ class CassBotCore(irc.IRCClient):
         'joined',
         'left',
         'chanSynced',
+        'channelNamesReceived',
+        'channelModesReceived',
         'noticed',
         'modeChanged',
         'serverModeChanged',
@@ -206,11 +267,67 @@ class CassBotCore(irc.IRCClient):
         'action',
         'topicUpdated',
         'userRenamed',
+        'netsplit',
+        'netjoin',
         'receivedMOTD',
         'msg'
     )
+    # the position of the channel argument for each overrideable method which
+    # has one. plugins can be limited to some channels for these; see
+    # CassBotService.set_plugin_channels.
+    channel_args = {
+        'privmsg': 1,
+        'joined': 0,
+        'left': 0,
+        'chanSynced': 0,
+        'channelNamesReceived': 0,
+        'channelModesReceived': 0,
+        'noticed': 1,
+        'modeChanged': 1,
+        'channelModeChanged': 1,
+        'kickedFrom': 0,
+        'userJoined': 1,
+        'userLeft': 1,
+        'userKicked': 1,
+        'action': 1,
+        'topicUpdated': 1,
+        'msg': 0,
+    }
+
+    # position of the message argument for the events which are only passed
+    # to plugins whose messageFilters it passes
+    filtered_args = {
+        'privmsg': 2,
+        'action': 2,
+    }
+
     mode = 'irc'
     ping_interval = 120
+    debug_show_input = False
+
+    # flood control for outgoing messages: up to outbound_burst lines at
+    # once, then outbound_rate lines per second
+    outbound_rate = 0.5
+    outbound_burst = 5
+
+    # the server adds ':nick!user@host ' to our lines before relaying them,
+    # and the whole thing has to fit in 510 bytes (512 with the CRLF).
+    # we don't know our user@host as seen by others, so assume the worst.
+    max_line_bytes = 510
+    hostmask_reserve = len(':!@ ') + 10 + 63
+
+    # command output longer than this many lines is paged; the rest is kept
+    # until asked for with the 'more' command. None disables paging.
+    page_lines = 6
+
+    # QUITs with a netsplit message are held back until none has come for
+    # netsplit_window seconds. if at least netsplit_min_users quit that way,
+    # plugins get a single netsplit event, and the same users coming back
+    # within netsplit_memory seconds get a single netjoin; otherwise they
+    # are passed on as ordinary userQuit and userJoined events.
+    netsplit_window = 2
+    netsplit_min_users = 3
+    netsplit_memory = 3600
 
     def __init__(self, nickname='cassbot'):
         # state that will be saved and reset on this object by the service
@@ -223,10 +340,18 @@ class CassBotCore(irc.IRCClient):
         self.is_channel_synced = {}
         self.server_modemap = {}
         self.topic_map = {}
-        self.channel_memberships = {}
+        self.membership = ChannelMembership()
+        # channel -> [(nick, modes)] from NAMES replies not yet finished
+        self.names_batches = {}
+        # (event name, servers) -> SplitBatch still being collected
+        self.split_batches = {}
+        # nick -> (servers, time) for users who left in a netsplit
+        self.split_nicks = {}
         self.is_signed_on = False
         self.init_time = time.time()
         self.pinglooper = None
+        self.outqueue = None
+        self.more_buffer = None
 
         for mname in self.overrideable:
             realmethod = getattr(self, mname, noop)
@@ -234,21 +359,150 @@ class CassBotCore(irc.IRCClient):
             setattr(self, mname, wrappedmethod)
 
     def make_watch_wrapper(self, mname, realmethod):
-        @defer.inlineCallbacks
         def wrapper(*a, **kw):
-            realresult = yield realmethod(*a, **kw)
-            watchers = self.service.watcher_map.get(mname, ())
-            for w in watchers:
-                pluginmethod = getattr(w, mname, noop)
-                try:
-                    yield pluginmethod(self, *a, **kw)
-                except Exception, e:
-                    log.err(None, 'Exception in plugin %s for method %r'
-                                  % (w.name(), mname))
-            defer.returnValue(realresult)
+            realresult = realmethod(*a, **kw)
+            if isinstance(realresult, defer.Deferred):
+                return realresult.addCallback(self.run_watchers, mname, a, kw)
+            return self.run_watchers(realresult, mname, a, kw)
         wrapper.func_name = 'wrapper_for_%s' % mname
         return wrapper
 
+    def run_watchers(self, realresult, mname, a, kw, handlers=None):
+        """
+        Call every plugin watching mname, using the bound methods precompiled
+        by the service in scan_plugins.
+
+        By default the watchers run in order: everything happens
+        synchronously until some plugin returns a Deferred; from then on,
+        the remaining watchers are run one after another as each result
+        arrives, and a Deferred is returned which fires with realresult.
+
+        If the service has concurrent_dispatch set, see fan_out_watchers.
+        """
+
+        if handlers is None:
+            handlers = self.watchers_for(mname, a, kw)
+            if mname in self.filtered_args and self.service.message_filters:
+                handlers = self.service.filter_handlers(handlers, a[self.filtered_args[mname]])
+        if self.service.concurrent_dispatch:
+            return self.fan_out_watchers(handlers, realresult, mname, a, kw)
+        return self.run_watchers_in_order(handlers, realresult, mname, a, kw)
+
+    def watchers_for(self, mname, a, kw):
+        """
+        Return the (plugin, bound method) pairs watching mname for an event
+        with the given arguments, leaving out plugins limited to channels
+        other than the event's.
+        """
+        scoped = self.service.scoped_dispatch.get(mname)
+        if scoped is None:
+            return self.service.dispatch_table.get(mname, ())
+        default, bychannel = scoped
+        pos = self.channel_args[mname]
+        channel = a[pos] if len(a) > pos else kw.get('channel')
+        return bychannel.get(channel, default)
+
+    def run_watchers_in_order(self, handlers, realresult, mname, a, kw,
+                              timed=False):
+        for pos, (p, pluginmethod) in enumerate(handlers):
+            try:
+                res = pluginmethod(self, *a, **kw)
+            except Exception:
+                log.err(None, 'Exception in plugin %s for method %r'
+                              % (p.name(), mname))
+                continue
+            if isinstance(res, defer.Deferred):
+                return self.finish_watchers(res, p, handlers[pos+1:],
+                                            realresult, mname, a, kw, timed)
+        return realresult
+
+    @defer.inlineCallbacks
+    def finish_watchers(self, d, p, handlers, realresult, mname, a, kw,
+                        timed=False):
+        while True:
+            if timed:
+                d = self.watch_deadline(d, p, mname)
+            try:
+                yield d
+            except Exception:
+                log.err(None, 'Exception in plugin %s for method %r'
+                              % (p.name(), mname))
+            if not handlers:
+                break
+            (p, pluginmethod), handlers = handlers[0], handlers[1:]
+            d = defer.maybeDeferred(pluginmethod, self, *a, **kw)
+        defer.returnValue(realresult)
+
+    def fan_out_watchers(self, handlers, realresult, mname, a, kw):
+        """
+        Start all the watchers for mname at once, without waiting for any
+        Deferreds they return. Each of those Deferreds gets a deadline (see
+        watch_deadline); plugins which are still running when it passes are
+        cancelled.
+
+        Plugins with a true ordered_dispatch attribute are not started
+        concurrently with each other: they are run in order, as they would
+        be by run_watchers_in_order, though alongside all the others.
+
+        Returns realresult if nothing is left running, or else a Deferred
+        which fires with realresult once every watcher has finished or been
+        cancelled.
+        """
+
+        pending = []
+        ordered = []
+        for p, pluginmethod in handlers:
+            if getattr(p, 'ordered_dispatch', False):
+                ordered.append((p, pluginmethod))
+                continue
+            try:
+                res = pluginmethod(self, *a, **kw)
+            except Exception:
+                log.err(None, 'Exception in plugin %s for method %r'
+                              % (p.name(), mname))
+                continue
+            if isinstance(res, defer.Deferred):
+                pending.append(self.watch_deadline(res, p, mname))
+        if ordered:
+            res = self.run_watchers_in_order(ordered, None, mname, a, kw,
+                                             timed=True)
+            if isinstance(res, defer.Deferred):
+                pending.append(res)
+        if not pending:
+            return realresult
+        return defer.DeferredList(pending).addCallback(lambda _: realresult)
+
+    def watch_deadline(self, d, p, mname):
+        """
+        Arrange for d, which was returned by plugin p's handler for mname,
+        to be cancelled if it has not fired after the plugin's
+        dispatch_timeout (or the service's watcher_timeout) seconds. Returns
+        a Deferred which fires with None when d is done, after logging any
+        error or timeout.
+        """
+
+        timeout = getattr(p, 'dispatch_timeout', self.service.watcher_timeout)
+        timer = None
+        if timeout is not None:
+            timer = self.service.reactor.callLater(
+                timeout, self.watcher_timed_out, d, p, mname, timeout)
+        def finished(result):
+            timed_out = timer is not None and not timer.active()
+            if timer is not None and not timed_out:
+                timer.cancel()
+            if isinstance(result, failure.Failure):
+                if timed_out and result.check(defer.CancelledError):
+                    # already logged by watcher_timed_out
+                    return
+                log.err(result, 'Exception in plugin %s for method %r'
+                                % (p.name(), mname))
+        return d.addBoth(finished)
+
+    def watcher_timed_out(self, d, p, mname, timeout):
+        log.msg('Plugin %s took more than %s seconds handling %r; cancelling.'
+                % (p.name(), timeout, mname))
+        d.cancel()
+
     def add_channel(self, channel):
         self.channels.add(channel)
 
@@ -257,7 +511,8 @@ class CassBotCore(irc.IRCClient):
         removekey(self.topic_map, channel)
         removekey(self.chan_modemap, channel)
         removekey(self.is_channel_synced, channel)
-        removekey(self.channel_memberships, channel)
+        self.membership.remove_channel(channel)
+        removekey(self.names_batches, channel)
 
     def dispatch_command(self, user, channel, cmd, args):
         cmd = cmd.lower().replace('-', '_')
@@ -282,16 +537,99 @@ class CassBotCore(irc.IRCClient):
                                 "Error in the %r command: %s" % (cmd, err.value))
 
     @defer.inlineCallbacks
-    def address_msg(self, user, channel, msg, prefix=True):
+    def address_msg(self, user, channel, msg, prefix=True,
+                    priority=PRIORITY_COMMAND, pack=False, paginate=True):
+        """
+        Send msg to channel, prefixed with user's nick, or to user directly
+        if channel is our own nick. Lines which would be too long for the
+        server are split at word boundaries, and each piece gets the prefix.
+        If pack is true, short lines are joined together where they fit.
+
+        If paginate is true and this is command output with more than
+        page_lines lines, only the first page is sent, and the rest is kept
+        for the user to fetch with 'more' (see send_more).
+        """
         if '!' in user:
             user = user.split('!', 1)[0]
-        transform = lambda m:m
-        if channel == self.nickname:
+        prefixstr = ''
+        private = channel == self.nickname
+        if private:
             channel = user
         elif prefix:
-            transform = lambda m: '%s: %s' % (user, m)
+            prefixstr = '%s: ' % (user,)
+        limit = self.line_byte_limit(channel)
+        if limit is not None:
+            limit -= len(prefixstr)
+        lines = []
         for line in msg.split('\n'):
-            yield self.msg(channel, transform(line))
+            lines.extend(split_message(line, limit))
+        if pack:
+            lines = pack_lines(lines, limit)
+        if paginate and priority == PRIORITY_COMMAND and \
+                self.page_lines is not None and len(lines) > self.page_lines:
+            kept = self.more_buffer.store((user, channel), lines[self.page_lines:])
+            lines = lines[:self.page_lines] + [self.more_notice(kept, private)]
+        for line in lines:
+            yield self.msg(channel, prefixstr + line, priority=priority)
+
+    def more_notice(self, remaining, private):
+        return "(%d more line%s; say '%s' to see them)" \
+               % (remaining, '' if remaining == 1 else 's',
+                  self.command_hint('more', private))
+
+    def command_hint(self, command, private):
+        """
+        Return what a user should say to give us the named command: the
+        bare command in a private message, and in a channel, the command
+        with our cmd_prefix, or addressed to our nick if there's no prefix.
+        """
+        if private:
+            return command
+        if self.cmd_prefix is not None:
+            return self.cmd_prefix + command
+        return '%s: %s' % (self.nickname, command)
+
+    def send_more(self, user, channel):
+        """
+        Send the next page of output stored for user in channel by
+        address_msg.
+        """
+        nick = user.split('!', 1)[0]
+        private = channel == self.nickname
+        dest = nick if private else channel
+        lines, remaining = self.more_buffer.take((nick, dest), self.page_lines)
+        if not lines:
+            return self.address_msg(user, channel, 'No more output for you here.')
+        if remaining:
+            lines.append(self.more_notice(remaining, private))
+        return self.address_msg(user, channel, '\n'.join(lines), paginate=False)
+
+    def line_byte_limit(self, target):
+        """
+        Return the number of bytes of text that can go in one message to
+        target, or None if there is no limit.
+        """
+        return (self.max_line_bytes - len(self.nickname) - self.hostmask_reserve
+                - len('PRIVMSG %s :' % (target,)))
+
+    def msg(self, user, message, length=None, priority=PRIORITY_COMMAND):
+        """
+        Queue a message to be sent once flood control allows. Replies to
+        commands (PRIORITY_COMMAND) are sent before passive output
+        (PRIORITY_PASSIVE), like links posted in response to channel chatter.
+        Overlong lines are split at word boundaries.
+        """
+        limit = self.line_byte_limit(user)
+        for line in message.split('\n'):
+            for piece in split_message(line, limit):
+                self.outqueue.put(user, piece, length=length, priority=priority)
+
+    def send_msg_now(self, user, message, length=None):
+        if length is None:
+            # already split to fit by msg(); newer Twisted versions would
+            # otherwise re-split using their own, smaller, estimate
+            return self.sendLine('PRIVMSG %s :%s' % (user, message))
+        return irc.IRCClient.msg(self, user, message, length)
 
     def command_not_found(self, user, channel, cmd):
         return self.address_msg(user, channel, "Sorry, I don't understand '%s'. :(" % cmd)
@@ -312,27 +650,29 @@ class CassBotCore(irc.IRCClient):
 
     def privmsg(self, user, channel, message):
         cmdstr = None
-        if channel == self.nickname:
-            cmdstr = message
-        if message.startswith('%s:' % (self.nickname,)):
-            cmdstr = message[len(self.nickname)+1:]
+        nick = self.nickname
+        if message.startswith(nick) and message[len(nick):len(nick)+1] == ':':
+            cmdstr = message[len(nick)+1:]
         elif self.cmd_prefix is not None and message.startswith(self.cmd_prefix):
             cmdstr = message[len(self.cmd_prefix):]
+        elif channel == nick:
+            cmdstr = message
         if cmdstr is not None:
-            parts = shlex.split(cmdstr.strip())
-            cmd = parts[0]
-            args = parts[1:]
-            self.dispatch_command(user, channel, cmd, args)
+            parts = split_command(cmdstr)
+            if parts:
+                self.dispatch_command(user, channel, parts[0], parts[1:])
 
     def joined(self, channel):
-        self.channel_memberships[channel] = set()
+        self.membership.add_channel(channel)
         self.is_channel_synced[channel] = False
         self.add_channel(channel)
         self.join_channels.add(channel)
+        self.service.mark_dirty(('service', 'channels'))
         self.requestChannelMode(channel)
 
     def leave(self, channel, reason=None):
         self.join_channels.discard(channel)
+        self.service.mark_dirty(('service', 'channels'))
         return irc.IRCClient.leave(self, channel, reason=reason)
 
     def left(self, channel):
@@ -364,6 +704,13 @@ class CassBotCore(irc.IRCClient):
             removekey(self.server_modemap[user], mode)
 
     def channelModeChanged(self, user, channel, beingset, mode, arg):
+        self.apply_channel_mode(channel, beingset, mode, arg)
+
+    def apply_channel_mode(self, channel, beingset, mode, arg):
+        if arg is not None and self.membership.is_member(arg, channel):
+            self.membership.set_mode(channel, arg, mode, beingset)
+            return
+        # channel modes, keyed by their argument (None for simple flags)
         modeset = self.chan_modemap.setdefault(channel, {}).setdefault(arg, set())
         if beingset:
             modeset.add(mode)
@@ -381,17 +728,16 @@ class CassBotCore(irc.IRCClient):
         self.pinglooper.start(self.ping_interval, now=False)
 
     def userJoined(self, user, channel):
-        self.channel_memberships.setdefault(channel, set()).add(user)
+        self.membership.join(user, channel)
 
     def userLeft(self, user, channel):
-        self.channel_memberships.setdefault(channel, set()).discard(user)
-        removekey(self.chan_modemap.get(channel, {}), user)
+        self.membership.part(user, channel)
 
     def userKicked(self, kickee, channel, kicker, message):
-        self.userLeft(kickee, channel)
+        self.membership.part(kickee, channel)
 
-    def userQuit(self, user, channel):
-        self.userLeft(user, channel)
+    def userQuit(self, user, quitMessage):
+        self.membership.quit(user)
         self.server_modemap.pop(user, None)
 
     def chanSynced(self, channel):
@@ -401,12 +747,7 @@ class CassBotCore(irc.IRCClient):
         self.topic_map[channel] = newTopic
 
     def userRenamed(self, oldname, newname):
-        for cm in self.channel_memberships.itervalues():
-            if oldname in cm:
-                cm.add(newname)
-                cm.remove(oldname)
-        for modemap in self.chan_modemap.itervalues():
-            modemap[newname] = modemap.pop(oldname, set())
+        self.membership.rename(oldname, newname)
         modes = self.server_modemap.pop(oldname, None)
         if modes:
             self.server_modemap[newname] = modes
@@ -420,42 +761,184 @@ class CassBotCore(irc.IRCClient):
         if self.pinglooper is not None:
             self.pinglooper.stop()
             self.pinglooper = None
+        if self.outqueue is not None:
+            self.outqueue.clear()
+        for batch in self.split_batches.itervalues():
+            batch.timer.cancel()
+        self.split_batches = {}
         return irc.IRCClient.connectionLost(self, reason)
 
     def pingServer(self):
         return self.sendLine('PING %s' % (self.servername,))
 
     def lineReceived(self, line):
-        if getattr(self, 'debug_show_input', False):
+        if self.debug_show_input:
             print "LINE: %r" % line
+        # most of what we get is PRIVMSG, so parse the common form of that
+        # directly instead of through parsemsg and handleCommand. anything
+        # with low-level quoting or CTCP, or otherwise unusual, goes the
+        # long way.
+        if line[:1] == ':' and irc.M_QUOTE not in line:
+            sp = line.find(' ')
+            if line.startswith('PRIVMSG ', sp + 1):
+                target, colon, message = line[sp+9:].partition(' :')
+                if colon and message[:1] != irc.X_DELIM and ' ' not in target:
+                    if message:
+                        try:
+                            self.privmsg(line[1:sp], target, message)
+                        except Exception:
+                            log.deferr()
+                    return
         return irc.IRCClient.lineReceived(self, line)
 
+    def irc_QUIT(self, prefix, params):
+        nick = prefix.split('!', 1)[0]
+        message = params[0] if params else ''
+        servers = netsplit_servers(message)
+        if servers is None:
+            self.split_nicks.pop(nick, None)
+            return self.userQuit(nick, message)
+        chans = self.membership.quit(nick)
+        self.server_modemap.pop(nick, None)
+        self.split_nicks[nick] = (servers, self.service.reactor.seconds())
+        self.add_to_split_batch('netsplit', servers, nick, chans)
+
+    def irc_JOIN(self, prefix, params):
+        nick = prefix.split('!', 1)[0]
+        split = self.split_nicks.get(nick)
+        if split is not None and nick != self.nickname:
+            servers, when = split
+            if self.service.reactor.seconds() - when <= self.netsplit_memory:
+                channel = params[-1]
+                self.membership.join(nick, channel)
+                return self.add_to_split_batch('netjoin', servers, nick, [channel])
+            del self.split_nicks[nick]
+        return irc.IRCClient.irc_JOIN(self, prefix, params)
+
+    def add_to_split_batch(self, mname, servers, nick, channels):
+        key = (mname, servers)
+        batch = self.split_batches.get(key)
+        if batch is None:
+            batch = self.split_batches[key] = SplitBatch()
+        else:
+            batch.timer.cancel()
+        batch.add(nick, channels)
+        batch.timer = self.service.reactor.callLater(self.netsplit_window,
+                                                     self.finish_split_batch, key)
+
+    def finish_split_batch(self, key):
+        """
+        Report a burst of netsplit QUITs or rejoins to the plugins, once it
+        seems to be over. The channel state was updated as they arrived.
+        """
+        mname, servers = key
+        batch = self.split_batches.pop(key)
+        users = batch.users()
+        if mname == 'netsplit':
+            peruser_mname = 'userQuit'
+            message = ' '.join(servers)
+            peruser_args = [(nick, message) for (nick, chans) in users]
+        else:
+            peruser_mname = 'userJoined'
+            peruser_args = [(nick, chan) for (nick, chans) in users for chan in chans]
+
+        if mname == 'netjoin' or len(batch) < self.netsplit_min_users:
+            # they're back (or never really split), so any later JOINs are
+            # ordinary ones
+            for nick, chans in users:
+                self.split_nicks.pop(nick, None)
+        if len(batch) < self.netsplit_min_users:
+            # too few to be a netsplit worth mentioning; pass them on to
+            # every plugin as usual
+            for a in peruser_args:
+                self.run_watchers(None, peruser_mname, a, {})
+            return
+        getattr(self, mname)(servers, users)
+        if mname == 'netsplit':
+            self.expire_split_nicks()
+        for a in peruser_args:
+            handlers = tuple(h for h in self.watchers_for(peruser_mname, a, {})
+                             if h[0].netsplit_user_events)
+            if handlers:
+                self.run_watchers(None, peruser_mname, a, {}, handlers=handlers)
+
+    def expire_split_nicks(self):
+        cutoff = self.service.reactor.seconds() - self.netsplit_memory
+        for nick, (servers, when) in self.split_nicks.items():
+            if when < cutoff:
+                del self.split_nicks[nick]
+
+    def netsplit(self, servers, users):
+        """
+        Called when the servers named by the pair servers split, with a list
+        of (nick, channels) for the users who were lost.
+        """
+
+    def netjoin(self, servers, users):
+        """
+        Called when users lost in a netsplit come back, with a list of
+        (nick, channels) for them.
+        """
+
+    def prefix_modes(self):
+        """
+        Map the nick prefixes used in NAMES replies to the channel modes
+        they stand for, as announced by the server.
+        """
+        supported = getattr(self, 'supported', None)
+        prefixes = supported.getFeature('PREFIX') if supported is not None else None
+        if not prefixes:
+            return {'@': 'o', '+': 'v'}
+        return dict((symbol, mode) for (mode, (symbol, _)) in prefixes.iteritems())
+
+    # NAMES and MODE replies are applied to the channel state directly, in
+    # one pass, instead of going through modeChanged for every user; plugins
+    # get a single channelNamesReceived or channelModesReceived per reply.
+
     def irc_RPL_NAMREPLY(self, prefix, params):
         channel, nlist = params[-2:]
-        memb = self.channel_memberships.setdefault(channel, set())
-        chanmap = self.chan_modemap.setdefault(channel, {})
+        prefix_modes = self.prefix_modes()
+        membership = self.membership
+        batch = self.names_batches.setdefault(channel, [])
         for name in nlist.split():
-            if name.startswith('@'):
-                name = name[1:]
-                self.modeChanged(None, channel, True, 'o', (name,))
-            if name.startswith('+'):
+            modes = ''
+            while name and name[0] in prefix_modes:
+                modes += prefix_modes[name[0]]
                 name = name[1:]
-                self.modeChanged(None, channel, True, 'v', (name,))
-            memb.add(name)
+            membership.join(name, channel)
+            for m in modes:
+                membership.set_mode(channel, name, m, True)
+            batch.append((name, modes))
 
     def irc_RPL_ENDOFNAMES(self, prefix, params):
         channel = params[-2]
+        names = self.names_batches.pop(channel, [])
+        self.channelNamesReceived(channel, names)
         self.chanSynced(channel)
 
+    def channelNamesReceived(self, channel, names):
+        """
+        Called once a NAMES reply for channel is complete, with a list of
+        (nick, modes) for everyone in it; modes is a string of the channel
+        modes each nick has, such as 'o' or 'v'.
+        """
+
     def irc_RPL_CHANNELMODEIS(self, prefix, params):
         channel = params[1]
         modes = params[2]
         modeparams = params[3:]
         added, removed = irc.parseModes(modes, modeparams, self.getChannelModeParams())
         for mode, arg in added:
-            self.modeChanged(None, channel, True, mode, (arg,))
+            self.apply_channel_mode(channel, True, mode, arg)
         for mode, arg in removed:
-            self.modeChanged(None, channel, False, mode, (arg,))
+            self.apply_channel_mode(channel, False, mode, arg)
+        self.channelModesReceived(channel, added)
+
+    def channelModesReceived(self, channel, modes):
+        """
+        Called with the current modes of channel, as a list of (mode, arg),
+        when the server reports them in answer to requestChannelMode.
+        """
 
     def requestChannelMode(self, channel):
         self.sendLine('MODE %s' % channel)
@@ -469,82 +952,318 @@ def splituser(user):
         return (parts[0], '', hostparts[0])
     return (parts[0], hostparts[0], hostparts[1])
 
+def split_command(text):
+    """
+    Split a command into words as shlex.split would, honouring single and
+    double quotes and backslash escapes, but quicker, and without failing on
+    bad quoting: a quote left open runs to the end of the text, and a
+    backslash at the very end is kept.
+    """
+    if '"' not in text and "'" not in text and '\\' not in text:
+        return text.split()
+    words = []
+    word = []
+    in_word = False
+    quote = None
+    i, n = 0, len(text)
+    while i < n:
+        c = text[i]
+        if quote == "'":
+            if c == "'":
+                quote = None
+            else:
+                word.append(c)
+        elif quote == '"':
+            if c == '"':
+                quote = None
+            elif c == '\\' and i + 1 < n and text[i+1] in '\\"':
+                i += 1
+                word.append(text[i])
+            else:
+                word.append(c)
+        elif c.isspace():
+            if in_word:
+                words.append(''.join(word))
+                word = []
+                in_word = False
+        else:
+            in_word = True
+            if c == "'" or c == '"':
+                quote = c
+            elif c == '\\' and i + 1 < n:
+                i += 1
+                word.append(text[i])
+            else:
+                word.append(c)
+        i += 1
+    if in_word:
+        words.append(''.join(word))
+    return words
+
 def mask_matches(mask, user):
     mparts = splituser(mask)
     uparts = splituser(user)
     return all(imap(fnmatch, uparts, mparts))
 
+def glob_to_regex(pat):
+    """
+    Like fnmatch.translate, but the result can be embedded in a larger
+    regex, and wildcards never match the NUL which HostmaskMatcher puts
+    between the parts of a user.
+    """
+    i, n = 0, len(pat)
+    res = []
+    while i < n:
+        c = pat[i]
+        i += 1
+        if c == '*':
+            res.append('[^\x00]*')
+        elif c == '?':
+            res.append('[^\x00]')
+        elif c == '[':
+            j = i
+            if j < n and pat[j] == '!':
+                j += 1
+            if j < n and pat[j] == ']':
+                j += 1
+            while j < n and pat[j] != ']':
+                j += 1
+            if j >= n:
+                res.append('\\[')
+            else:
+                stuff = pat[i:j].replace('\\', '\\\\')
+                i = j + 1
+                if stuff[0] == '!':
+                    stuff = '^\x00' + stuff[1:]
+                elif stuff[0] == '^':
+                    stuff = '\\' + stuff
+                res.append('[%s]' % stuff)
+        else:
+            res.append(re.escape(c))
+    return ''.join(res)
+
+class HostmaskMatcher(object):
+    """
+    Tests users against a whole set of masks at once, with the same
+    results as calling mask_matches on each mask. Masks without wildcards
+    are looked up in a set; the others are compiled together into a single
+    regex. Recent answers are cached, keeping roughly the cache_size most
+    recently used ones.
+
+    The set of masks is fixed; make a new matcher when it changes. Masks
+    which can't be compiled (such as those with a backwards character range)
+    are logged and left out.
+    """
+
+    cache_size = 1024
+    wildcard_chars = re.compile(r'[*?[]')
+
+    def __init__(self, masks=()):
+        self.masks = frozenset(masks)
+        self.exact = set()
+        patterns = []
+        for mask in self.masks:
+            parts = splituser(mask)
+            if any(self.wildcard_chars.search(part) for part in parts):
+                pattern = '\x00'.join(imap(glob_to_regex, parts))
+                try:
+                    re.compile(pattern)
+                except re.error, e:
+                    log.msg('Ignoring unusable hostmask %r: %s' % (mask, e))
+                    continue
+                patterns.append(pattern)
+            else:
+                self.exact.add(parts)
+        self.regex = None
+        if patterns:
+            self.regex = re.compile('(?:%s)\\Z' % '|'.join(patterns), re.S)
+        self.cache = {}
+        self.old_cache = {}
+
+    def __len__(self):
+        return len(self.masks)
+
+    def matches(self, user):
+        try:
+            return self.cache[user]
+        except KeyError:
+            pass
+        result = self.old_cache.get(user)
+        if result is None:
+            result = self.match_uncached(user)
+        if len(self.cache) >= self.cache_size:
+            # the current generation becomes the old one, and anything not
+            # used since the last rollover is forgotten
+            self.old_cache = self.cache
+            self.cache = {}
+        self.cache[user] = result
+        return result
+
+    def match_uncached(self, user):
+        parts = splituser(user)
+        if parts in self.exact:
+            return True
+        if self.regex is None:
+            return False
+        return self.regex.match('\x00'.join(parts)) is not None
+
+
+class MessageFilter(object):
+    """
+    Tests whether a message contains any of a set of literal strings or
+    matches any of a set of regexes. The literals, and the regexes without
+    flags or groups, are combined into a single regex, so that a message
+    matching none of them is usually rejected with one search. The other
+    regexes are tried one by one: flags can't be given for part of a
+    regex, and combining would renumber groups, breaking backreferences.
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        sources = []
+        self.regexes = []
+        for pat in self.patterns:
+            if isinstance(pat, basestring):
+                sources.append(re.escape(pat))
+            elif pat.flags or pat.groups:
+                self.regexes.append(pat)
+            else:
+                sources.append('(?:%s)' % pat.pattern)
+        self.combined = None
+        if sources:
+            try:
+                self.combined = re.compile('|'.join(sources))
+            except re.error:
+                self.combined = re.compile('|'.join(re.escape(pat) for pat in self.patterns
+                                                    if isinstance(pat, basestring)) or '(?!)')
+                self.regexes.extend(pat for pat in self.patterns
+                                    if not isinstance(pat, basestring)
+                                    and pat not in self.regexes)
+
+    def matches(self, message):
+        if self.combined is not None and self.combined.search(message) is not None:
+            return True
+        for regex in self.regexes:
+            if regex.search(message) is not None:
+                return True
+        return False
+
 
 class AuthMap:
-    def __init__(self):
+    def __init__(self, on_change=None):
         self.memberships = {}
         self.per_channel = {}
+        # privname -> every mask granting it, directly or through other
+        # privileges named as members; see rebuild()
+        self.closure = {}
+        # privname -> HostmaskMatcher for its closure, built as needed
+        self.matchers = {}
+        # called with no arguments whenever the privileges are changed
+        self.on_change = on_change
+
+    def changed(self):
+        if self.on_change is not None:
+            self.on_change()
 
     def addPriv(self, mask, privname):
+        was_cyclic = privname in self.closure.get(privname, ())
         self.memberships.setdefault(privname, set()).add(mask)
+        self.rebuild()
+        if not was_cyclic and privname in self.closure.get(privname, ()):
+            log.msg('Privilege %r now includes itself by way of %r' % (privname, mask))
+        self.changed()
 
     def removePriv(self, mask, privname):
+        members = self.memberships.get(privname)
+        if members is None or mask not in members:
+            return
+        members.remove(mask)
+        if not members:
+            del self.memberships[privname]
+        self.rebuild()
+        self.changed()
+
+    def rebuild(self):
+        """
+        Recompute the closure of every privilege: its members, the members
+        of any privilege named among those, and so on. This happens only
+        when memberships change, so checking a privilege never has to walk
+        the graph, and cycles in it are harmless.
+        """
+        closure = {}
+        for privname in self.memberships:
+            seen = set()
+            pending = [privname]
+            while pending:
+                for mask in self.memberships.get(pending.pop(), ()):
+                    if mask not in seen:
+                        seen.add(mask)
+                        pending.append(mask)
+            closure[privname] = frozenset(seen)
+        self.closure = closure
+        self.matchers = {}
+
+    def matcher(self, privname):
         try:
-            self.memberships[privname].remove(mask)
+            return self.matchers[privname]
         except KeyError:
-            pass
+            m = self.matchers[privname] = HostmaskMatcher(self.closure.get(privname, ()))
+            return m
 
-    def userHas(self, user, privname, skip=set()):
-        members = self.whoHas(privname)
-        for mask in members:
-            if mask_matches(mask, user):
-                return True
-        # avoid circular paths
-        newskip = skip | set(members)
-        for m in members:
-            if m in skip:
-                continue
-            if self.userHas(user, m, skip=newskip):
-                return True
-        return False
+    def userHas(self, user, privname):
+        if privname not in self.closure:
+            return False
+        return self.matcher(privname).matches(user)
 
     def whoHas(self, privname):
         return self.memberships.get(privname, ())
 
-    def _for_channels(f):
-        @wraps(f)
-        def wrap(self, channel, *a, **kw):
-            try:
-                c = self.per_channel[channel]
-            except KeyError:
-                c = self.per_channel[channel] = AuthMap()
-            return f(self, c, *a, **kw)
-        return wrap
-
-    @_for_channels
-    def addChannelPriv(self, c, mask, privname):
-        return c.addPriv(mask, privname)
+    # only channels with at least one grant have an entry in per_channel,
+    # so that asking about other channels costs no memory.
 
-    @_for_channels
-    def removeChannelPriv(self, c, mask, privname):
-        return c.removePriv(mask, privname)
+    def addChannelPriv(self, channel, mask, privname):
+        c = self.per_channel.get(channel)
+        if c is None:
+            c = self.per_channel[channel] = AuthMap(on_change=self.changed)
+        return c.addPriv(mask, privname)
 
-    @_for_channels
-    def channelUserHas(self, c, user, privname):
+    def removeChannelPriv(self, channel, mask, privname):
+        c = self.per_channel.get(channel)
+        if c is None:
+            return
+        c.removePriv(mask, privname)
+        if not c.memberships:
+            del self.per_channel[channel]
+
+    def channelUserHas(self, channel, user, privname):
+        c = self.per_channel.get(channel)
+        if c is None:
+            return False
         return c.userHas(user, privname)
 
-    @_for_channels
-    def channelWhoHas(self, c, privname):
-        return c.addPriv(privname)
-
-    del _for_channels
+    def channelWhoHas(self, channel, privname):
+        c = self.per_channel.get(channel)
+        if c is None:
+            return ()
+        return c.whoHas(privname)
 
     def saveState(self):
-        return (self.memberships,
+        return (dict((k, set(v)) for (k, v) in self.memberships.iteritems()),
                 dict((k, v.saveState()) for (k, v) in self.per_channel.iteritems()
                                         if v.memberships))
 
     def loadState(self, newstate):
         # throw away current info!
-        self.memberships, per_chan_info = newstate
+        memberships, per_chan_info = newstate
+        self.memberships = dict((k, v) for (k, v) in memberships.iteritems() if v)
+        self.rebuild()
+        self.per_channel = {}
         for k, v in per_chan_info.iteritems():
-            self.per_channel[k] = c = AuthMap()
+            c = AuthMap(on_change=self.changed)
             c.loadState(v)
+            if c.memberships:
+                self.per_channel[k] = c
+        self.changed()
 
 
 class CassBotFactory(protocol.ReconnectingClientFactory):
@@ -563,11 +1282,41 @@ class CassBotFactory(protocol.ReconnectingClientFactory):
         log.err(reason, 'Connection lost')
         protocol.ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
 
+def migrate_state_v1(state):
+    """
+    Version 1 statefiles were a plain pickle of the service state, with
+    each plugin's state object unpickled along with everything else.
+    """
+    state['plugins'] = dict((pname, StateSection(pstate, 1))
+                            for (pname, pstate) in state.get('plugins', {}).iteritems())
+    return state
+
+
 class CassBotService(service.MultiService):
     plugin_scan_period = 240
+
+    # changes are appended to the journal every journal_flush_period
+    # seconds; it is folded into a full snapshot (a checkpoint) every
+    # checkpoint_period seconds, or sooner if it grows past
+    # journal_max_bytes.
+    journal_flush_period = 5
+    journal_max_bytes = 1024 * 1024
+    checkpoint_period = 3600
+
+    # when true, all plugins watching an event are started at once instead
+    # of one after another; see CassBotCore.fan_out_watchers. Plugins can
+    # override watcher_timeout with their own dispatch_timeout attribute.
+    concurrent_dispatch = False
+    watcher_timeout = 30
     default_statefile = 'cassbot.state.db'
     protocol_factory_class = CassBotFactory
 
+    # layout of the saved state. to change it, bump state_format_version
+    # and add a function to state_migrations which turns a state of the
+    # previous version into one of the new version.
+    state_format_version = 2
+    state_migrations = {1: migrate_state_v1}
+
     def __init__(self, desc, nickname='cassbot', init_channels=(), reactor=None,
                  statefile=None):
         service.MultiService.__init__(self)
@@ -578,8 +1327,9 @@ class CassBotService(service.MultiService):
             'channels': set(init_channels),
             'cmd_prefix': None,
             'plugins': {},
+            'plugin_channels': {},
         }
-        self.auth = AuthMap()
+        self.auth = AuthMap(on_change=lambda: self.mark_dirty(('auth_map',)))
 
         if reactor is None:
             from twisted.internet import reactor
@@ -589,7 +1339,38 @@ class CassBotService(service.MultiService):
 
         self.watcher_map = {}
         self.command_map = {}
+        self.dispatch_table = {}
+        # mname -> (handlers for other channels, {channel: handlers}), for
+        # the methods some plugin is limited to certain channels for
+        self.scoped_dispatch = {}
+        self.plugin_registrations = {}
+        # plugin -> MessageFilter, for plugins with messageFilters
+        self.message_filters = {}
+        # MessageFilter for all of them together, or None
+        self.combined_filter = None
+        # pname -> [messages passed, messages skipped] by its filter
+        self.filter_stats = {}
+        # while registering a batch of plugins (see batch_registrations):
+        # the method names whose dispatch needs recompiling, whether the
+        # combined filter needs rebuilding, and (Deferred, plugin) pairs to
+        # fire once everything is in place
+        self.batch_depth = 0
+        self.batch_methods = set()
+        self.batch_filters = False
+        self.batch_loaded = []
         self.scanning_now = False
+        self.plugin_index = None
+        self.plugin_fingerprint = None
+        self.plugin_scanner = None
+        self.checkpointer = None
+        self.checkpoint_lock = defer.DeferredLock()
+        self.journal = StateJournal(self.statefile + '.journal')
+        self.journal_generation = 1
+        self.journal_flusher = None
+        self.kvdb = None
+        # keys (as used in journal records) of state changed since the last
+        # journal flush or checkpoint
+        self.dirty = set()
 
         # all 'enabled' or 'loaded' plugins have an entry in here, keyed by
         # the plugin name (as given by the .name() classmethod).
@@ -622,18 +1403,90 @@ class CassBotService(service.MultiService):
         except (IOError, ValueError):
             pass
         self.setupConnection()
+        self.plugin_scanner = task.LoopingCall(self.check_plugin_files)
+        self.plugin_scanner.clock = self.reactor
+        self.plugin_scanner.start(self.plugin_scan_period, now=False)
+        self.checkpointer = task.LoopingCall(self.periodic_checkpoint)
+        self.checkpointer.clock = self.reactor
+        self.checkpointer.start(self.checkpoint_period, now=False)
+        self.journal_flusher = task.LoopingCall(self.periodic_journal_flush)
+        self.journal_flusher.clock = self.reactor
+        self.journal_flusher.start(self.journal_flush_period, now=False)
         return res
 
     def stopService(self):
-        self.saveStateToFile(self.statefile)
-        self.teardownConnection()
-        return service.MultiService.stopService(self)
+        for looper in (self.plugin_scanner, self.checkpointer, self.journal_flusher):
+            if looper is not None and looper.running:
+                looper.stop()
+        self.plugin_scanner = self.checkpointer = self.journal_flusher = None
+        # wait for any checkpoint or journal flush in progress, so it can't
+        # overwrite what we save here
+        d = self.checkpoint_lock.run(self.saveStateToFile, self.statefile)
+        d.addErrback(log.err, 'Saving state on shutdown')
+        d.addCallback(lambda _: self.teardownConnection())
+        d.addCallback(lambda _: self.close_plugin_stores())
+        d.addCallback(lambda _: service.MultiService.stopService(self))
+        return d
+
+    def close_plugin_stores(self):
+        if self.kvdb is not None:
+            self.kvdb.close()
+            self.kvdb = None
+
+    def get_plugin_classes(self):
+        """
+        Return the known plugin classes. Discovering these is expensive, so
+        they are kept in an index which is only rebuilt when it has been
+        invalidated; check_plugin_files does that when the files in the
+        plugin path change.
+        """
+        if self.plugin_index is None:
+            self.refresh_plugin_index()
+        return self.plugin_index
+
+    def refresh_plugin_index(self):
+        self.plugin_fingerprint = self.plugin_path_fingerprint()
+        self.plugin_index = tuple(p for p in getPlugins(IBotPlugin, cassbot_plugins)
+                                  if p is not BaseBotPlugin)
+
+    def invalidate_plugin_index(self):
+        self.plugin_index = None
 
     @staticmethod
-    def get_plugin_classes():
-        for p in getPlugins(IBotPlugin, cassbot_plugins):
-            if p is not BaseBotPlugin:
-                yield p
+    def plugin_path_fingerprint():
+        """
+        Return something which will compare unequal to its previous value if
+        any python file in the plugin path has been added, removed or
+        changed.
+        """
+        fingerprint = []
+        for d in cassbot_plugins.__path__:
+            try:
+                names = os.listdir(d)
+            except OSError:
+                continue
+            for n in sorted(names):
+                if not n.endswith('.py'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(d, n))
+                except OSError:
+                    continue
+                fingerprint.append((d, n, st.st_mtime, st.st_size))
+        return tuple(fingerprint)
+
+    def check_plugin_files(self):
+        """
+        Rebuild the plugin index and rescan if the plugin files have changed
+        since it was built. Called every plugin_scan_period seconds while
+        the service is running.
+        """
+        if self.plugin_index is not None and \
+                self.plugin_path_fingerprint() == self.plugin_fingerprint:
+            return
+        log.msg('Plugin files have changed; rescanning plugins.')
+        self.refresh_plugin_index()
+        self.scan_plugins()
 
     def scan_plugins(self):
         # wrap _really_scan_plugins, in case some callback inside
@@ -652,33 +1505,274 @@ class CassBotService(service.MultiService):
             self.scanning_now = False
 
     def _really_scan_plugins(self):
-        self.watcher_map = {}
-        self.command_map = {}
-        for pclass in self.get_plugin_classes():
-            pname = pclass.name()
-            try:
-                p = self.pluginmap[pname]
-            except KeyError:
-                # not enabled
-                continue
-            if isinstance(p, enabled_but_not_found):
-                # hey, we found it. load it up
-                log.msg('Loading plugin %s (first time)...' % pname)
-                p = self.enable_plugin_class(pclass, p.when_found, pname)
-                if p is None:
+        """
+        Load any enabled plugins which have been found since they were
+        enabled, and re-ask all the loaded ones which methods and commands
+        they want. enable_plugin_by_name and disable_plugin keep the maps up
+        to date on their own, so this is only needed when the set of plugin
+        classes or their interests might have changed.
+        """
+        self.begin_batch()
+        try:
+            for pclass in self.get_plugin_classes():
+                pname = pclass.name()
+                try:
+                    p = self.pluginmap[pname]
+                except KeyError:
+                    # not enabled
                     continue
+                if isinstance(p, enabled_but_not_found):
+                    # hey, we found it. load it up
+                    log.msg('Loading plugin %s (first time)...' % pname)
+                    self.enable_plugin_class(pclass, p.when_found, pname)
+                else:
+                    self.refresh_plugin_registration(pname, p)
+        finally:
+            self.end_batch()
+
+    def plugin_interests(self, p):
+        """
+        Return the method names and command names the given plugin wants,
+        as two tuples.
+        """
+        methods = cmds = ()
+        try:
+            methods = tuple(p.interestingMethods())
+        except Exception:
+            log.err(None, 'Exception in plugin %s for interestingMethods request'
+                          % (p.name(),))
+        try:
+            cmds = tuple(p.implementedCommands())
+        except Exception:
+            log.err(None, 'Exception in plugin %s for implementedCommands request'
+                          % (p.name(),))
+        return methods, cmds
+
+    def register_plugin(self, pname, p, interests=None):
+        """
+        Add a loaded plugin to watcher_map, command_map and dispatch_table.
+        Only the entries for the methods it is interested in are touched.
+        """
+        if interests is None:
+            interests = self.plugin_interests(p)
+        methods, cmds = interests
+        self.plugin_registrations[pname] = (p, methods, cmds)
+        for methodname in methods:
+            self.watcher_map.setdefault(methodname, []).append(p)
+        for cmdname in cmds:
+            self.command_map.setdefault(cmdname, []).append(p)
+        self.registration_changed(pname, methods)
+
+    def unregister_plugin(self, pname):
+        """
+        Remove a plugin added by register_plugin from the maps, touching only
+        the entries it was in.
+        """
+        try:
+            p, methods, cmds = self.plugin_registrations.pop(pname)
+        except KeyError:
+            return
+        for mapping, names in ((self.watcher_map, methods), (self.command_map, cmds)):
+            for name in names:
+                plist = mapping.get(name, [])
+                if p in plist:
+                    plist.remove(p)
+                if not plist:
+                    mapping.pop(name, None)
+        self.registration_changed(pname, methods)
+
+    def registration_changed(self, pname, methods):
+        self.refresh_message_filter(pname)
+        if self.batch_depth:
+            self.batch_methods.update(methods)
+            self.batch_filters = True
+        else:
+            self.rebuild_combined_filter()
+            self.recompile_dispatch(methods)
+
+    def begin_batch(self):
+        self.batch_depth += 1
+
+    def end_batch(self):
+        """
+        Finish a batch of registrations started with begin_batch: compile
+        the dispatch tables and combined filter once for all of them, then
+        fire the Deferreds of the plugins loaded during the batch.
+        """
+        self.batch_depth -= 1
+        if self.batch_depth:
+            return
+        methods, self.batch_methods = self.batch_methods, set()
+        if self.batch_filters:
+            self.batch_filters = False
+            self.rebuild_combined_filter()
+        self.recompile_dispatch(methods)
+        loaded, self.batch_loaded = self.batch_loaded, []
+        for deferred, p in loaded:
+            deferred.callback(p)
+
+    def refresh_plugin_registration(self, pname, p):
+        interests = self.plugin_interests(p)
+        registered = self.plugin_registrations.get(pname)
+        if registered is not None and registered[0] is p \
+                and registered[1:] == interests:
+            return
+        self.unregister_plugin(pname)
+        self.register_plugin(pname, p, interests)
+
+    def recompile_dispatch(self, methodnames):
+        for mname in methodnames:
+            handlers = self.compile_handlers(mname, self.watcher_map.get(mname, ()))
+            if handlers:
+                self.dispatch_table[mname] = handlers
+            else:
+                self.dispatch_table.pop(mname, None)
+            scoped = self.compile_scoped_handlers(mname, handlers)
+            if scoped is not None:
+                self.scoped_dispatch[mname] = scoped
+            else:
+                self.scoped_dispatch.pop(mname, None)
+
+    def compile_scoped_handlers(self, mname, handlers):
+        """
+        If any of the handlers for mname belong to plugins limited to some
+        channels, return a pair: the handlers to run for channels none of
+        them are limited to, and a dict mapping each of their channels to
+        the handlers to run there. Otherwise return None.
+        """
+        if mname not in CassBotCore.channel_args:
+            return None
+        limits = [self.plugin_channels(p.name(), mname) for (p, method) in handlers]
+        if all(chans is None for chans in limits):
+            return None
+        scoped_channels = set()
+        for chans in limits:
+            if chans is not None:
+                scoped_channels.update(chans)
+        default = tuple(h for (h, chans) in izip(handlers, limits) if chans is None)
+        bychannel = {}
+        for channel in scoped_channels:
+            bychannel[channel] = tuple(h for (h, chans) in izip(handlers, limits)
+                                       if chans is None or channel in chans)
+        return default, bychannel
+
+    def update_message_filters(self, pname):
+        """
+        Ask the named plugin for its messageFilters again, and rebuild the
+        combined filter.
+        """
+        self.refresh_message_filter(pname)
+        self.rebuild_combined_filter()
+
+    def refresh_message_filter(self, pname):
+        for p in self.message_filters.keys():
+            if p.name() == pname:
+                del self.message_filters[p]
+        registered = self.plugin_registrations.get(pname)
+        if registered is not None:
+            p = registered[0]
             try:
-                for methodname in p.interestingMethods():
-                    self.watcher_map.setdefault(methodname, []).append(p)
-            except Exception:
-                log.err(None, 'Exception in plugin %s for interestingMethods request'
-                              % (p.name(),))
-            try:
-                for cmdname in p.implementedCommands():
-                    self.command_map.setdefault(cmdname, []).append(p)
+                patterns = p.messageFilters()
             except Exception:
-                log.err(None, 'Exception in plugin %s for implementedCommands request'
-                              % (p.name(),))
+                log.err(None, 'Exception in plugin %s for messageFilters request' % (pname,))
+                patterns = None
+            if patterns is not None:
+                self.message_filters[p] = MessageFilter(patterns)
+                self.filter_stats.setdefault(pname, [0, 0])
+
+    def rebuild_combined_filter(self):
+        if self.message_filters:
+            self.combined_filter = MessageFilter(
+                    [pat for f in self.message_filters.itervalues() for pat in f.patterns])
+        else:
+            self.combined_filter = None
+
+    def filter_handlers(self, handlers, message):
+        """
+        Return those of handlers whose plugins' message filters (if any)
+        pass message.
+        """
+        filters = self.message_filters
+        anything = self.combined_filter.matches(message)
+        kept = []
+        for handler in handlers:
+            f = filters.get(handler[0])
+            if f is None:
+                kept.append(handler)
+            elif anything and f.matches(message):
+                self.filter_stats[handler[0].name()][0] += 1
+                kept.append(handler)
+            else:
+                self.filter_stats[handler[0].name()][1] += 1
+        return kept
+
+    def plugin_channels(self, pname, mname):
+        """
+        Return the set of channels in which the named plugin gets mname
+        events, or None if it isn't limited. A limit given for the method
+        name '*' applies to all methods without one of their own.
+        """
+        limits = self.state.get('plugin_channels', {}).get(pname)
+        if not limits:
+            return None
+        return limits.get(mname, limits.get('*'))
+
+    def set_plugin_channels(self, pname, mname, channels):
+        """
+        Only pass mname events for the given channels to the named plugin;
+        mname may be '*' to cover all its methods. channels=None removes the
+        limit. Only methods listed in CassBotCore.channel_args can be
+        limited, and private messages to the bot count as being in the
+        channel named by the bot's nick.
+        """
+        # replaced rather than changed in place, since snapshots of the
+        # state share it
+        all_limits = dict(self.state.get('plugin_channels', {}))
+        limits = dict(all_limits.get(pname, {}))
+        if channels is None:
+            limits.pop(mname, None)
+        else:
+            limits[mname] = frozenset(channels)
+        if limits:
+            all_limits[pname] = limits
+        else:
+            all_limits.pop(pname, None)
+        self.state['plugin_channels'] = all_limits
+        self.mark_dirty(('service', 'plugin_channels'))
+        if mname == '*':
+            self.recompile_dispatch(CassBotCore.channel_args.keys())
+        else:
+            self.recompile_dispatch([mname])
+
+    @staticmethod
+    def compile_handlers(mname, watchers):
+        """
+        Turn a list of plugins watching mname into a tuple of (plugin, bound
+        method) pairs, so that dispatching an event doesn't have to look
+        anything up on the plugins.
+        """
+
+        handlers = []
+        for w in watchers:
+            pluginmethod = getattr(w, mname, None)
+            if pluginmethod is not None:
+                handlers.append((w, pluginmethod))
+        return tuple(handlers)
+
+    def plugin_store(self, pname):
+        """
+        Return the persistent key-value store for the named plugin. All
+        plugins share one sqlite database next to the statefile, each in
+        its own namespace.
+        """
+        if self.kvdb is None:
+            self.kvdb = KeyValueDB(self.statefile + '.store')
+        return self.kvdb.namespace(pname)
+
+    def find_plugin_class(self, pname):
+        for pclass in self.get_plugin_classes():
+            if pclass.name() == pname:
+                return pclass
 
     def enable_plugin_by_name(self, pname):
         """
@@ -696,10 +1790,31 @@ class CassBotService(service.MultiService):
         if p is None:
             p = self.pluginmap[pname] = enabled_but_not_found()
         if isinstance(p, enabled_but_not_found):
-            self.scan_plugins()
+            pclass = self.find_plugin_class(pname)
+            if pclass is not None:
+                log.msg('Loading plugin %s (first time)...' % pname)
+                self.enable_plugin_class(pclass, p.when_found, pname)
+            else:
+                # its file may have been added since the index was built;
+                # if so, the rescan loads it
+                self.check_plugin_files()
             return p.when_found
         return defer.succeed(p)
 
+    def enable_plugins(self, pnames):
+        """
+        Enable all the named plugins, as enable_plugin_by_name would, and
+        return a list of the corresponding Deferreds. The plugins are all
+        added to the maps first, and the dispatch tables and combined
+        message filter compiled once at the end, however many are given.
+        """
+
+        self.begin_batch()
+        try:
+            return [self.enable_plugin_by_name(pname) for pname in pnames]
+        finally:
+            self.end_batch()
+
     def enable_plugin_class(self, pclass, deferred, pname):
         """
         Enable the given plugin class. Return the new plugin object,
@@ -712,7 +1827,8 @@ class CassBotService(service.MultiService):
         log.msg('Instantiating plugin %s' % pname)
         try:
             self.pluginmap[pname] = p = pclass()
-            pstate = self.state['plugins'].get(pname)
+            p.store = self.plugin_store(pname)
+            pstate = self.decode_plugin_state(p, pname)
             if pstate:
                 log.msg('Loading state for plugin %s' % pname)
                 p.loadState(pstate)
@@ -720,16 +1836,23 @@ class CassBotService(service.MultiService):
             self.pluginmap.pop(pname, None)
             deferred.errback()
             return
-        deferred.callback(p)
+        self.register_plugin(pname, p)
+        self.mark_dirty(('service', 'plugins_enabled'))
+        if self.batch_depth:
+            self.batch_loaded.append((deferred, p))
+        else:
+            deferred.callback(p)
         return p
 
     def disable_plugin(self, pname):
         """
         Disable the plugin with the given name. If it was actually loaded and
-        enabled before, as expected, save its state first.
+        enabled before, as expected, save its state first, then let it tear
+        itself down.
         """
 
         p = self.pluginmap.pop(pname, None)
+        self.unregister_plugin(pname)
         if p is not None and not isinstance(p, enabled_but_not_found):
             log.msg('Disabling plugin %s. Saving state.' % pname)
             try:
@@ -740,18 +1863,25 @@ class CassBotService(service.MultiService):
             if pstate is None:
                 self.state['plugins'].pop(pname, None)
             else:
-                self.state['plugins'][pname] = pstate
-        self.scan_plugins()
+                self.state['plugins'][pname] = StateSection(pstate, p.state_version)
+            self.mark_plugin_dirty(pname)
+            try:
+                p.teardown()
+            except Exception:
+                log.err(None, 'Exception in plugin %s during teardown' % pname)
+        self.mark_dirty(('service', 'plugins_enabled'))
 
     def join(self, channelname, channelkey=None):
         bot = self.getbot()
         self.state.setdefault('channels', set()).add(channelname)
+        self.mark_dirty(('service', 'channels'))
         if bot is not None:
             return bot.join(channelname, key=channelkey)
 
     def leave(self, channelname, reason=None):
         bot = self.getbot()
         self.state.get('channels', set()).discard(channelname)
+        self.mark_dirty(('service', 'channels'))
         if bot is not None:
             return bot.leave(channelname, reason=reason)
 
@@ -760,40 +1890,230 @@ class CassBotService(service.MultiService):
         proto.join_channels = self.state.setdefault('channels', set())
         proto.cmd_prefix = self.state.get('cmd_prefix', None)
         proto.service = self
+        proto.outqueue = OutboundQueue(proto.send_msg_now, self.reactor,
+                                       proto.outbound_rate, proto.outbound_burst,
+                                       limitfunc=proto.line_byte_limit)
+        proto.more_buffer = MoreBuffer(self.reactor)
 
     def initialize_plugin_state(self, plugin):
-        try:
-            pstate = self.state['plugins'][plugin.name()]
-        except KeyError:
-            pass
-        else:
+        pstate = self.decode_plugin_state(plugin, plugin.name())
+        if pstate is not None:
             try:
                 plugin.loadState(pstate)
             except Exception:
                 log.err(None, "Trying to load state in plugin %s" % plugin.name())
 
+    def decode_plugin_state(self, plugin, pname):
+        """
+        Unpickle the saved state for the named plugin, migrating it to the
+        plugin's current state_version if necessary. Returns None if there
+        is no saved state.
+
+        If the state can't be decoded, that is logged and the exception
+        passed on, so the plugin isn't enabled. The saved section stays as
+        it was, to be decoded once the plugin is fixed, instead of being
+        replaced by the empty state of a plugin started without it.
+        """
+        section = self.state['plugins'].get(pname)
+        if section is None:
+            return None
+        try:
+            pstate = section.decode()
+            if section.version != plugin.state_version:
+                log.msg('Migrating state for plugin %s from version %s to %s'
+                        % (pname, section.version, plugin.state_version))
+                pstate = plugin.migrateState(pstate, section.version)
+        except Exception:
+            log.err(None, 'Could not decode saved state for plugin %s; not enabling it'
+                          % pname)
+            raise
+        return pstate
+
+    def plugin_section(self, pname, p):
+        pstate = p.saveState()
+        if pstate is None:
+            return None
+        return StateSection(pstate, p.state_version)
+
+    def mark_dirty(self, key):
+        """
+        Note that the state identified by key has changed and should be
+        written to the journal with the next flush. Keys are ('plugin',
+        pname), ('auth_map',) or ('service', name) for a key in self.state.
+        """
+        self.dirty.add(key)
+
+    def mark_plugin_dirty(self, pname):
+        """
+        Plugins should call this (as bot.service.mark_plugin_dirty(
+        self.name())) after changing any state they return from saveState,
+        so that it gets saved within seconds rather than at the next full
+        checkpoint.
+        """
+        self.mark_dirty(('plugin', pname))
+
+    def current_value(self, key):
+        kind = key[0]
+        if kind == 'plugin':
+            pname = key[1]
+            p = self.pluginmap.get(pname)
+            if p is None or isinstance(p, enabled_but_not_found):
+                return self.state['plugins'].get(pname)
+            return self.plugin_section(pname, p)
+        elif kind == 'auth_map':
+            return self.auth.saveState()
+        elif key == ('service', 'plugins_enabled'):
+            return self.pluginmap.keys()
+        elif key == ('service', 'channels'):
+            return set(self.state.get('channels', ()))
+        return self.state.get(key[1])
+
+    def apply_journal_record(self, key, value):
+        kind = key[0]
+        if kind == 'plugin':
+            if value is None:
+                self.state['plugins'].pop(key[1], None)
+            else:
+                if not isinstance(value, StateSection):
+                    # written before plugin state was versioned
+                    value = StateSection(value, 1)
+                self.state['plugins'][key[1]] = value
+        elif kind == 'auth_map':
+            self.state['auth_map'] = value
+        else:
+            self.state[key[1]] = value
+
+    def capture_state(self):
+        """
+        Return a snapshot of all the state that should be saved, including
+        the current state of every loaded plugin. Plugins stay loaded.
+        """
+        snapshot = dict(self.state)
+        snapshot['channels'] = set(self.state.get('channels', ()))
+        plugin_states = snapshot['plugins'] = dict(self.state['plugins'])
+        for pname, p in self.pluginmap.iteritems():
+            if isinstance(p, enabled_but_not_found):
+                continue
+            try:
+                section = self.plugin_section(pname, p)
+            except Exception:
+                log.err(None, 'Trying to save state for plugin %s' % pname)
+                continue
+            if section is None:
+                plugin_states.pop(pname, None)
+            else:
+                plugin_states[pname] = section
+        snapshot['plugins_enabled'] = self.pluginmap.keys()
+        snapshot['auth_map'] = self.auth.saveState()
+        snapshot['state_format_version'] = self.state_format_version
+        return snapshot
+
+    def begin_checkpoint(self):
+        """
+        Take a snapshot which folds in the current journal, and move on to
+        the next journal generation. Returns the snapshot and the new
+        generation, which finish_checkpoint needs.
+        """
+        snapshot = self.capture_state()
+        self.dirty.clear()
+        snapshot['journal_generation'] = self.journal_generation
+        self.journal_generation += 1
+        return snapshot, self.journal_generation
+
+    @staticmethod
+    def write_state(statefile, snapshot):
+        atomic_write(statefile, pickle.dumps(snapshot, -1))
+
+    def finish_checkpoint(self, statefile, snapshot, generation):
+        self.write_state(statefile, snapshot)
+        self.journal.reset(generation)
+
     def saveStateToFile(self, statefile):
-        # XXX: this disables plugins when capturing their state to save. it
-        # probably shouldn't, so that admins can save settings whenever they
-        # like without restarting the whole bot
+        snapshot, generation = self.begin_checkpoint()
+        self.finish_checkpoint(statefile, snapshot, generation)
+
+    def checkpoint(self):
+        """
+        Save the current state to the statefile without blocking: the
+        snapshot is taken right away (or as soon as any checkpoint or
+        journal flush already in progress is done), then pickled and
+        written out in a thread, and the journal is emptied. Returns a
+        Deferred which fires when that is all done.
+        """
+        return self.checkpoint_lock.run(self._checkpoint)
 
-        self.state['plugins_enabled'] = self.pluginmap.keys()
-        for pname in self.state['plugins_enabled']:
-            self.disable_plugin(pname)
-        self.state['auth_map'] = self.auth.saveState()
-        with open(statefile, 'w') as sfile:
-            pickle.dump(self.state, sfile, -1)
+    def _checkpoint(self):
+        snapshot, generation = self.begin_checkpoint()
+        return threads.deferToThread(self.finish_checkpoint, self.statefile,
+                                     snapshot, generation)
+
+    def periodic_checkpoint(self):
+        return self.checkpoint().addErrback(log.err, 'Periodic state checkpoint')
+
+    def flush_journal(self):
+        """
+        Append the current values of everything marked dirty to the
+        journal, in a thread. If that makes the journal too big, follow up
+        with a checkpoint.
+        """
+        return self.checkpoint_lock.run(self._flush_journal)
+
+    def _flush_journal(self):
+        if not self.dirty:
+            return
+        records = []
+        for key in self.dirty:
+            try:
+                records.append((key, self.current_value(key)))
+            except Exception:
+                log.err(None, 'Trying to get current state for %r' % (key,))
+        self.dirty.clear()
+        d = threads.deferToThread(self.journal.append, records)
+        def maybe_compact(_):
+            if self.journal.size() > self.journal_max_bytes:
+                return self._checkpoint()
+        return d.addCallback(maybe_compact)
+
+    def periodic_journal_flush(self):
+        return self.flush_journal().addErrback(log.err, 'Flushing state journal')
 
     def loadStateFromFile(self, statefile):
-        with open(statefile, 'r') as sfile:
-            self.state = pickle.load(sfile)
+        """
+        Load the last snapshot saved to statefile, if there is one, and
+        replay any journal written since.
+        """
+        if os.path.exists(statefile):
+            with open(statefile, 'r') as sfile:
+                self.state = self.migrate_state(pickle.load(sfile))
+        self.replay_journal()
         auth_dat = self.state.get('auth_map')
         if auth_dat is not None:
             self.auth.loadState(auth_dat)
-        for pname in self.state.get('plugins_enabled', ()):
-            d = self.enable_plugin_by_name(pname)
+        pnames = self.state.get('plugins_enabled', ())
+        for pname, d in izip(pnames, self.enable_plugins(pnames)):
             d.addErrback(log.err, "Loading plugin %s" % pname)
         self.state['channels'] = set(self.state.get('channels', ()))
+        self.dirty.clear()
+
+    def migrate_state(self, state):
+        version = state.pop('state_format_version', 1)
+        while version < self.state_format_version:
+            log.msg('Migrating saved state from format version %d' % version)
+            state = self.state_migrations[version](state)
+            version += 1
+        return state
+
+    def replay_journal(self):
+        folded = self.state.pop('journal_generation', 0)
+        generation, records = self.journal.read()
+        if generation is not None and generation > folded:
+            log.msg('Replaying %d records from state journal' % len(records))
+            for key, value in records:
+                self.apply_journal_record(key, value)
+            self.journal_generation = generation
+        else:
+            self.journal_generation = folded + 1
+            self.journal.reset(self.journal_generation)
 
     def __str__(self):
         return '<%s object [%s]%s>' % (
@@ -1,4 +1,4 @@
-from cassbot import (BaseBotPlugin, enabled_but_not_found, require_priv,
+from cassbot import (BaseBotPlugin, CassBotCore, enabled_but_not_found, require_priv,
                      require_priv_in_channel, natural_list)
 from twisted.internet import defer
 from twisted.python import failure, log
@@ -29,7 +29,12 @@ class Admin(BaseBotPlugin):
         if notfound:
             output.append('modules enabled but not found: %s' % makelist(notfound))
         output.append('other available modules: %s' % makelist(available))
-        yield bot.address_msg(user, channel, '\n'.join(output))
+        yield bot.address_msg(user, channel, '\n'.join(output), pack=True)
+
+    def command_more(self, bot, user, channel, args):
+        if args:
+            return bot.address_msg(user, channel, 'usage: more')
+        return bot.send_more(user, channel)
 
     @require_priv('admin')
     @defer.inlineCallbacks
@@ -117,6 +122,74 @@ class Admin(BaseBotPlugin):
         yield bot.address_msg(user, channel, 'configured to join: %s'
                                              % natural_list(sorted(bot.join_channels)))
 
+    @require_priv('admin')
+    def command_modchannels(self, bot, user, channel, args):
+        usage = 'usage: modchannels modulename [methodname|* [channels...|all]]'
+        if len(args) == 0:
+            return bot.address_msg(user, channel, usage)
+        serv = bot.service
+        modname = args[0]
+        if len(args) == 1:
+            limits = serv.state.get('plugin_channels', {}).get(modname, {})
+            if not limits:
+                return bot.address_msg(user, channel, '%s gets events from all channels.' % modname)
+            return bot.address_msg(user, channel, '; '.join(
+                    '%s: %s' % (mname, makelist(chans))
+                    for (mname, chans) in sorted(limits.items())))
+        mname = args[1]
+        if mname != '*' and mname not in CassBotCore.channel_args:
+            return bot.address_msg(user, channel, 'Events for %s are not per channel; try one of: %s'
+                                                  % (mname, makelist(CassBotCore.channel_args)))
+        if len(args) == 2:
+            chans = serv.plugin_channels(modname, mname)
+            return bot.address_msg(user, channel, '%s gets %s events from %s.'
+                                                  % (modname, mname, 'all channels' if chans is None
+                                                                     else makelist(chans)))
+        if args[2:] == ['all']:
+            serv.set_plugin_channels(modname, mname, None)
+            return bot.address_msg(user, channel, '%s now gets %s events from all channels.'
+                                                  % (modname, mname))
+        serv.set_plugin_channels(modname, mname, args[2:])
+        return bot.address_msg(user, channel, '%s now gets %s events only from %s.'
+                                              % (modname, mname, makelist(args[2:])))
+
+    @require_priv('admin')
+    def command_outqueue(self, bot, user, channel, args):
+        if len(args) != 0:
+            return bot.address_msg(user, channel, 'usage: outqueue')
+        stats = bot.outqueue.stats()
+        bypri = ', '.join('%d: %d' % item for item in sorted(stats['depth_by_priority'].items()))
+        return bot.address_msg(user, channel,
+                'outgoing queue: %d queued (by priority: %s), oldest waiting %.1fs. '
+                '%d sent, %d delayed, mean wait %.1fs, max wait %.1fs, %d packed.'
+                % (stats['depth'], bypri or 'none', stats['oldest_wait'],
+                   stats['sent'], stats['delayed'], stats['mean_wait'],
+                   stats['max_wait'], stats['packed']))
+
+    @require_priv('admin')
+    def command_filterstats(self, bot, user, channel, args):
+        if len(args) != 0:
+            return bot.address_msg(user, channel, 'usage: filterstats')
+        stats = bot.service.filter_stats
+        if not stats:
+            return bot.address_msg(user, channel, 'No modules are using message filters.')
+        return bot.address_msg(user, channel, '; '.join(
+                '%s: %d passed, %d skipped' % (pname, passed, skipped)
+                for (pname, (passed, skipped)) in sorted(stats.items())))
+
+    @require_priv('admin')
+    def command_checkpoint(self, bot, user, channel, args):
+        if len(args) != 0:
+            return bot.address_msg(user, channel, 'usage: checkpoint')
+        d = bot.service.checkpoint()
+        def report_failure(f):
+            log.err(f, "Checkpoint requested by %r" % (user,))
+            return bot.address_msg(user, channel, 'Could not save state: %s'
+                                                  % f.getErrorMessage())
+        d.addCallbacks(lambda _: bot.address_msg(user, channel, 'State saved.'),
+                       report_failure)
+        return d
+
     @require_priv('admin')
     def command_die(self, bot, user, channel, args):
         bot.service.reactor.callLater(0, bot.service.stopService)
@@ -128,5 +201,6 @@ class Admin(BaseBotPlugin):
             return 'Module %s is not loaded.' % modname
         mod = getModule(p.__module__).load()
         reload(mod)
+        serv.invalidate_plugin_index()
         serv.disable_plugin(modname)
         return self.do_mod_enable(serv, modname)
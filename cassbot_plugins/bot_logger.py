@@ -11,7 +11,8 @@ class BotLogger(BaseBotPlugin):
                      for (chan, blist) in self.eterno_blacklist.iteritems())
 
     def saveState(self):
-        return self.per_channel_blacklist
+        return dict((chan, set(blist))
+                    for (chan, blist) in self.per_channel_blacklist.iteritems())
 
     def loadState(self, state):
         if isinstance(state, dict):
@@ -29,6 +30,7 @@ class BotLogger(BaseBotPlugin):
                     'channel. Shell-style wildcards are ok.')
         if len(args) == 1 and args[0] in ('me', user):
             bl.add(user)
+            bot.service.mark_plugin_dirty(self.name())
             return bot.address_msg(user, chan, 'Blacklisting you for %s.' % chan)
         if bot.service.auth.channelUserHas(chan, user, 'log_blacklist_admin'):
             added = []
@@ -36,6 +38,7 @@ class BotLogger(BaseBotPlugin):
                 if arg not in bl:
                     bl.add(arg)
                     added.append(arg)
+            bot.service.mark_plugin_dirty(self.name())
             return bot.address_msg(user, chan, 'Blacklisted %s'
                                                % natural_list(map(repr, added)))
         return bot.address_msg(user, chan,
@@ -52,6 +55,7 @@ class BotLogger(BaseBotPlugin):
         if len(args) == 1 and args[0] in ('me', user):
             if user in bl:
                 bl.discard(user)
+                bot.service.mark_plugin_dirty(self.name())
                 return bot.address_msg(user, chan, 'Unblacklisting you for %s.' % chan)
             return bot.address_msg(user, chan, 'You are not blacklisted in %s.' % chan)
         if bot.service.auth.channelUserHas(chan, user, 'log_blacklist_admin'):
@@ -60,6 +64,7 @@ class BotLogger(BaseBotPlugin):
                 if arg in bl:
                     bl.discard(arg)
                     found.append(arg)
+            bot.service.mark_plugin_dirty(self.name())
             return bot.address_msg(user, chan, 'Unblacklisted %s'
                                                % natural_list(map(repr, found)))
         return bot.address_msg(user, chan,
@@ -112,6 +117,14 @@ class BotLogger(BaseBotPlugin):
     def userQuit(self, bot, user, msg):
         self.irclog('%s quit [%s]' % (user, msg))
 
+    def netsplit(self, bot, servers, users):
+        self.irclog('NETSPLIT %s %s -!- %s quit' % (servers[0], servers[1],
+                                                    natural_list([nick for (nick, chans) in users])))
+
+    def netjoin(self, bot, servers, users):
+        self.irclog('NETJOIN %s %s -!- %s rejoined' % (servers[0], servers[1],
+                                                       natural_list([nick for (nick, chans) in users])))
+
     def userKicked(self, bot, kickee, chan, kicker, msg):
         self.irclog('%s was kicked from %s by %s [%s]' % (kickee, chan, kicker, msg))
 
@@ -124,7 +137,7 @@ class BotLogger(BaseBotPlugin):
     def receivedMOTD(self, bot, motd):
         self.irclog('MOTD %s' % (motd,))
 
-    def msg(self, bot, dest, msg, length=None):
+    def msg(self, bot, dest, msg, length=None, priority=None):
         self.irclog('[%s] <%s> %s' % (dest, bot.nickname, msg))
 
     def action(self, bot, user, chan, data):
@@ -1,10 +1,12 @@
 import re
+import time
+from collections import OrderedDict
 from string import Template
 from itertools import chain
 from twisted.internet import defer, error
 from twisted.python import log
 from twisted.web import soap, error as web_error
-from cassbot import BaseBotPlugin, mask_matches, require_priv
+from cassbot import BaseBotPlugin, HostmaskMatcher, PRIORITY_PASSIVE, require_priv
 
 def weed_duplicates(elements):
     already = set()
@@ -19,6 +21,110 @@ def listconcat(iterator_of_iterators):
 class NotAuthenticatedError(Exception):
     pass
 
+class TicketCache:
+    """
+    Ticket summaries already fetched from JIRA, so that a ticket mentioned
+    again soon after doesn't cost another SOAP call. Keys are (base_url,
+    projectname, ticket number). A summary of None records that the ticket
+    doesn't exist.
+
+    Entries expire after ttl seconds (negative_ttl for nonexistent
+    tickets), and the least recently used are dropped beyond max_entries.
+    If store (a PluginStore) is given, entries are kept there too, so they
+    survive restarts.
+    """
+
+    ttl = 6 * 3600
+    negative_ttl = 600
+    max_entries = 2000
+    key_prefix = 'ticket:'
+
+    def __init__(self, store=None, clock=time.time):
+        self.store = store
+        self.clock = clock
+        # key -> (expiry time, summary), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        if store is not None:
+            self.load()
+
+    def store_key(self, key):
+        base_url, projectname, ticketnum = key
+        return '%s%s %s-%d' % (self.key_prefix, base_url, projectname, ticketnum)
+
+    def load(self):
+        now = self.clock()
+        live = []
+        expired = []
+        for skey, (key, expires, summary) in self.store.scan(self.key_prefix):
+            if expires > now:
+                live.append((expires, key, summary))
+            else:
+                expired.append(skey)
+        live.sort()
+        for expires, key, summary in live[-self.max_entries:]:
+            self.entries[key] = (expires, summary)
+        self.persist(lambda: [self.store.delete(skey) for skey in expired])
+
+    def persist(self, f):
+        if self.store is None:
+            return
+        try:
+            with self.store.transaction():
+                f()
+        except Exception:
+            log.err(None, "Could not update the saved JIRA ticket cache")
+
+    def get(self, key):
+        """
+        Return (True, summary) if key is cached and fresh, else (False, None).
+        """
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] <= self.clock():
+            self.misses += 1
+            if entry is not None:
+                self.persist(lambda: self.store.delete(self.store_key(key)))
+            return False, None
+        self.entries[key] = entry
+        if entry[1] is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return True, entry[1]
+
+    def put(self, key, summary):
+        ttl = self.ttl if summary is not None else self.negative_ttl
+        expires = self.clock() + ttl
+        self.entries.pop(key, None)
+        self.entries[key] = (expires, summary)
+        evicted = []
+        while len(self.entries) > self.max_entries:
+            evicted.append(self.entries.popitem(last=False)[0])
+        def save():
+            self.store.put(self.store_key(key), (key, expires, summary))
+            for k in evicted:
+                self.store.delete(self.store_key(k))
+        self.persist(save)
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'negative_hits': self.negative_hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits + self.negative_hits) / lookups if lookups else 0.0,
+        }
+
+def ticket_missing(e):
+    """
+    Whether the web error e is JIRA's SOAP fault for a ticket which doesn't
+    exist (which can't be told from not being allowed to see it).
+    """
+    return 'does not exist' in (e.response or '')
+
 class JiraInstance:
     num_api_tries = 3
 
@@ -87,6 +193,9 @@ class JiraInstance:
     def find_ticket_references(self, message):
         return self.find_short_ticket_references(message) + self.find_project_ticket_references(message)
 
+    def cache_key(self, ticketnum):
+        return (self.base_url, self.projectname, ticketnum)
+
     def make_link(self, ticketnum):
         return '%s/browse/%s-%d' % (self.base_url, self.projectname, ticketnum)
 
@@ -94,8 +203,14 @@ class JiraInstance:
         return self.jira_soap_auth_call('getIssue', '%s-%d' % (self.projectname, ticketnum))
 
     @defer.inlineCallbacks
-    def link_ticket(self, ticketnum):
+    def link_ticket(self, ticketnum, cache=None):
         ticket_url = self.make_link(ticketnum)
+        if cache is not None:
+            found, summary = cache.get(self.cache_key(ticketnum))
+            if found:
+                if summary is None:
+                    defer.returnValue(ticket_url)
+                defer.returnValue('%s : %s' % (ticket_url, summary))
         for attempt in range(self.num_api_tries):
             try:
                 ticketdata = yield self.fetch_ticket_info(ticketnum)
@@ -103,6 +218,10 @@ class JiraInstance:
                 log.msg("(Not fetching JIRA ticket data; not authenticated)")
                 break
             except web_error.Error, e:
+                if ticket_missing(e):
+                    if cache is not None:
+                        cache.put(self.cache_key(ticketnum), None)
+                    break
                 log.err(None, "JIRA API problem [try %d]\n--------\n%s\n--------\n" % (attempt + 1, e.response))
                 yield self.jira_soap_proxy_auth()
             except error.ConnectError, e:
@@ -111,44 +230,66 @@ class JiraInstance:
                 log.err(None, "Unexpected error fetching JIRA ticket data.")
                 break
             else:
+                if cache is not None:
+                    cache.put(self.cache_key(ticketnum), ticketdata.summary)
                 defer.returnValue('%s : %s' % (ticket_url, ticketdata.summary))
         defer.returnValue(ticket_url)
 
-    def reply_to_text(self, message, outputcb):
+    def reply_to_text(self, message, outputcb, cache=None):
         ticketnums = weed_duplicates(self.find_ticket_references(message))
-        return defer.DeferredList([self.link_ticket(tnum).addCallback(outputcb) for tnum in ticketnums])
+        return defer.DeferredList([self.link_ticket(tnum, cache).addCallback(outputcb)
+                                   for tnum in ticketnums])
 
 class JiraIntegration(BaseBotPlugin):
     def __init__(self):
         BaseBotPlugin.__init__(self)
         self.jira_instances = []
+        self.ticket_cache = None
         self.link_ignore_list = []
+        self.link_ignore = HostmaskMatcher()
 
     def loadState(self, state):
         self.link_ignore_list = state.get('link_ignore_list', [])
+        self.link_ignore = HostmaskMatcher(self.link_ignore_list)
         instance_data = state.get('jira_instances', [])
         self.jira_instances = map(JiraInstance.from_save_data, instance_data)
 
     def saveState(self):
         return {
-            'link_ignore_list': self.link_ignore_list,
+            'link_ignore_list': list(self.link_ignore_list),
             'jira_instances': [j.to_save_data() for j in self.jira_instances],
         }
 
+    def messageFilters(self):
+        # every ticket reference has one of these in it
+        filters = []
+        for j in self.jira_instances:
+            filters.append(j.projectname + '-')
+            if j.shortcode is not None:
+                filters.append(j.shortcode)
+        return filters
+
+    def get_ticket_cache(self):
+        # self.store is only set after construction
+        if self.ticket_cache is None:
+            self.ticket_cache = TicketCache(self.store)
+        return self.ticket_cache
+
     def respond(self, msg, outputcb):
-        return defer.DeferredList([j.reply_to_text(msg, outputcb) for j in self.jira_instances])
+        cache = self.get_ticket_cache()
+        return defer.DeferredList([j.reply_to_text(msg, outputcb, cache) for j in self.jira_instances])
 
     def privmsg(self, bot, user, channel, msg):
-        for m in self.link_ignore_list:
-            if mask_matches(m, user):
-                return
-        return self.respond(msg, lambda r: bot.address_msg(user, channel, r, prefix=False))
+        if self.link_ignore.matches(user):
+            return
+        return self.respond(msg, lambda r: bot.address_msg(user, channel, r, prefix=False,
+                                                           priority=PRIORITY_PASSIVE))
 
     def action(self, bot, user, channel, msg):
-        for m in self.link_ignore_list:
-            if mask_matches(m, user):
-                return
-        return self.respond(msg, lambda r: bot.address_msg(user, channel, r, prefix=False))
+        if self.link_ignore.matches(user):
+            return
+        return self.respond(msg, lambda r: bot.address_msg(user, channel, r, prefix=False,
+                                                           priority=PRIORITY_PASSIVE))
 
     @require_priv('admin')
     @defer.inlineCallbacks
@@ -167,6 +308,8 @@ class JiraIntegration(BaseBotPlugin):
             yield bot.address_msg(user, channel, 'usage: add-jira <base_url> <projectname> [<shortcode> [<username> <password>]] [min=<N>]')
             return
         self.jira_instances.append(JiraInstance(base_url, projectname, shortcode, username, password, min_ticket=tmin))
+        bot.service.mark_plugin_dirty(self.name())
+        bot.service.update_message_filters(self.name())
 
     @require_priv('admin')
     @defer.inlineCallbacks
@@ -174,5 +317,19 @@ class JiraIntegration(BaseBotPlugin):
         if len(args) > 0:
             yield bot.address_msg(user, channel, 'usage: list-jiras')
             return
-        for j in self.jira_instances:
-            yield bot.address_msg(user, channel, '%s: base_url=%r, shortcode=%r' % (j.projectname, j.base_url, j.shortcode))
+        if self.jira_instances:
+            yield bot.address_msg(user, channel, '\n'.join('%s: base_url=%r, shortcode=%r' % (j.projectname, j.base_url, j.shortcode)
+                                                           for j in self.jira_instances),
+                                  pack=True)
+
+    @require_priv('admin')
+    @defer.inlineCallbacks
+    def command_jira_cache_stats(self, bot, user, channel, args):
+        if len(args) > 0:
+            yield bot.address_msg(user, channel, 'usage: jira-cache-stats')
+            return
+        stats = self.get_ticket_cache().stats()
+        yield bot.address_msg(user, channel,
+                'JIRA ticket cache: %(entries)d entries, %(hits)d hits, %(negative_hits)d '
+                'hits for missing tickets, %(misses)d misses, hit rate %(hit_rate).0f%%.'
+                % dict(stats, hit_rate=stats['hit_rate'] * 100))
@@ -1,8 +1,10 @@
 import re
-from string import Template
-from itertools import chain
+import sre_parse
+from sre_constants import LITERAL, SUBPATTERN
 from twisted.internet import defer
-from cassbot import BaseBotPlugin, mask_matches
+from twisted.python import log
+from cassbot import BaseBotPlugin, HostmaskMatcher, PRIORITY_PASSIVE, require_priv
+from ruleworker import RuleWorker, ResponseTemplate
 
 def weed_duplicates(elements):
     already = set()
@@ -11,44 +13,307 @@ def weed_duplicates(elements):
             already.add(e)
             yield e
 
+def required_literal(regex):
+    """
+    Return the longest string which every match of the compiled regex must
+    contain, as far as can be told from its top level, or '' if nothing is
+    certain.
+    """
+    if regex.flags & re.IGNORECASE:
+        return ''
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return ''
+    runs = ['']
+    def walk(seq):
+        for op, av in seq:
+            if op == LITERAL:
+                runs[-1] += chr(av) if av < 256 else unichr(av)
+            elif op == SUBPATTERN:
+                walk(av[-1])
+            else:
+                runs.append('')
+    walk(parsed)
+    return max(runs, key=len)
+
+def trie_regex(words):
+    """
+    Make a regex source matching any of words, shaped like a trie so that
+    the regex engine never has to try more than one alternative per
+    character. Where one word is a prefix of another, the longer one is
+    matched if possible.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for c in word:
+            node = node.setdefault(c, {})
+        node[''] = True
+    def build(node):
+        alts = [re.escape(c) + build(child) for (c, child) in sorted(node.items()) if c != '']
+        if not alts:
+            return ''
+        body = alts[0] if len(alts) == 1 else '(?:%s)' % '|'.join(alts)
+        if '' in node:
+            return '(?:%s)?' % body
+        return body
+    return build(trie)
+
+class RuleEngine:
+    """
+    Applies a whole list of (regex, ResponseTemplate) rules to a message
+    with a single scan for candidates, instead of running every regex.
+
+    Each rule's regex is examined for a literal string that any match must
+    contain. One trie-shaped regex finds all of those literals present in a
+    message, at every position (so overlapping ones too); only the rules
+    whose literal was seen, plus rules with no usable literal, have their
+    regex run. Responses come out in the same order as applying every rule
+    in turn would give.
+    """
+
+    # shorter literals are too common to rule much out
+    min_literal = 3
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.unfiltered = []
+        by_literal = {}
+        for i, (regex, response) in enumerate(self.rules):
+            lit = required_literal(regex)
+            if len(lit) < self.min_literal:
+                self.unfiltered.append(i)
+            else:
+                by_literal.setdefault(lit, []).append(i)
+        self.literals = by_literal.keys()
+        # the scanner finds the longest literal starting at each position,
+        # so each literal also stands for any others which are prefixes of it
+        self.rules_for = {}
+        for lit in self.literals:
+            indexes = []
+            for n in xrange(self.min_literal, len(lit) + 1):
+                indexes.extend(by_literal.get(lit[:n], ()))
+            self.rules_for[lit] = indexes
+        self.scanner = None
+        if self.literals:
+            self.scanner = re.compile('(?=(%s))' % trie_regex(self.literals))
+
+    def candidates(self, msg):
+        found = set(self.unfiltered)
+        if self.scanner is not None:
+            rules_for = self.rules_for
+            for lit in set(self.scanner.findall(msg)):
+                found.update(rules_for[lit])
+        return sorted(found)
+
+    def responses(self, msg):
+        """
+        Apply the rules to msg right here. This has no time limit, so it
+        isn't for use in the reactor; RegexResponder goes through a
+        RuleWorker.
+        """
+        for i in self.candidates(msg):
+            regex, response = self.rules[i]
+            for m in regex.finditer(msg):
+                yield response.render(m.groupdict())
+
+    def filters(self):
+        """
+        Literals which any message producing a response must contain, for
+        messageFilters, or None if some rules have no such literal.
+        """
+        if self.unfiltered:
+            return None
+        return list(self.literals)
+
 class RegexResponder(BaseBotPlugin):
+    """
+    Responds to messages matching any of a list of regexes.
+
+    The regexes are run in a separate process (see ruleworker), where each
+    rule gets rule_time_budget seconds of CPU time per message. A rule
+    which overruns that is quarantined: taken out of the list and kept
+    aside, with the reason, until an admin puts it back with release-rule.
+    The message it overran on is then evaluated again by the other rules.
+
+    Rules can be changed at runtime with the add-rule and remove-rule
+    commands. Each change builds a new rule list and RuleEngine and swaps
+    them in together, so a message is always handled by one complete set.
+    """
+
+    rule_time_budget = 0.5
+
     def __init__(self):
         BaseBotPlugin.__init__(self)
         self.response_rules = []
+        self.engine = RuleEngine(())
+        self.worker = None
+        # (pattern, response, reason)
+        self.quarantined = []
+        # pattern -> [evaluations, total seconds, max seconds]
+        self.rule_stats = {}
         self.link_ignore_list = []
+        self.link_ignore = HostmaskMatcher()
 
     def loadState(self, state):
         self.link_ignore_list = state.get('link_ignore_list', [])
+        self.link_ignore = HostmaskMatcher(self.link_ignore_list)
         newrules = state.get('response_rules', [])
-        self.response_rules = [(re.compile(r), sub) for (r, sub) in newrules]
+        self.quarantined = list(state.get('quarantined_rules', []))
+        self.set_rules([(re.compile(r), ResponseTemplate(sub)) for (r, sub) in newrules])
 
     def saveState(self):
         return {
-            'link_ignore_list': self.link_ignore_list,
-            'response_rules': [(r.pattern, sub) for (r, sub) in self.response_rules],
+            'link_ignore_list': list(self.link_ignore_list),
+            'response_rules': [(r.pattern, sub.template) for (r, sub) in self.response_rules],
+            'quarantined_rules': list(self.quarantined),
         }
 
-    def apply_rule(self, msg, pat, response):
-        for m in pat.finditer(msg):
-            yield Template(response).safe_substitute(m.groupdict())
+    def set_rules(self, rules):
+        engine = RuleEngine(rules)
+        self.response_rules, self.engine = engine.rules, engine
+        if self.worker is not None:
+            self.worker.set_engine(engine)
+
+    def messageFilters(self):
+        return self.engine.filters()
+
+    def get_worker(self, bot):
+        if self.worker is None:
+            serv = bot.service
+            self.worker = RuleWorker(serv.reactor, self.engine, self.rule_time_budget,
+                                     lambda rule, msg: self.quarantine(serv, rule, msg))
+        return self.worker
+
+    def quarantine(self, serv, rule, msg):
+        regex, sub = rule
+        reason = 'took over %ss of CPU time on %r' % (self.rule_time_budget, msg[:100])
+        log.msg('Quarantining response rule %r: %s' % (regex.pattern, reason))
+        self.record_time(regex.pattern, self.rule_time_budget)
+        if rule in self.response_rules:
+            self.set_rules([r for r in self.response_rules if r is not rule])
+            self.quarantined.append((regex.pattern, sub.template, reason))
+            serv.update_message_filters(self.name())
+            serv.mark_plugin_dirty(self.name())
+
+    def record_time(self, pattern, seconds):
+        stats = self.rule_stats.get(pattern)
+        if stats is None:
+            stats = self.rule_stats[pattern] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+    def evaluate(self, bot, msg):
+        d = self.get_worker(bot).evaluate(msg)
+        def got_results((responses, timings)):
+            for (regex, response), seconds in timings:
+                self.record_time(regex.pattern, seconds)
+            return responses
+        return d.addCallback(got_results)
 
-    def apply_all_rules(self, msg):
-        return chain(*[self.apply_rule(msg, pat, r) for (pat, r) in self.response_rules])
+    def teardown(self):
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
 
     @defer.inlineCallbacks
-    def respond(self, msg, outputcb):
-        responses = self.apply_all_rules(msg)
+    def respond(self, bot, msg, outputcb):
+        responses = yield self.evaluate(bot, msg)
         for response in weed_duplicates(responses):
             yield outputcb(response)
 
+    @require_priv('admin')
+    def command_add_rule(self, bot, user, channel, args):
+        if len(args) != 2:
+            return bot.address_msg(user, channel, 'usage: add-rule <regex> <response>')
+        pattern, response = args
+        try:
+            regex = re.compile(pattern)
+        except re.error, e:
+            return bot.address_msg(user, channel, 'Bad regex %r: %s' % (pattern, e))
+        self.set_rules(self.response_rules + [(regex, ResponseTemplate(response))])
+        bot.service.update_message_filters(self.name())
+        bot.service.mark_plugin_dirty(self.name())
+        return bot.address_msg(user, channel, 'Added rule %d.' % len(self.response_rules))
+
+    @require_priv('admin')
+    def command_remove_rule(self, bot, user, channel, args):
+        if len(args) != 1:
+            return bot.address_msg(user, channel, 'usage: remove-rule <number|regex>')
+        which = args[0]
+        if which.isdigit() and 1 <= int(which) <= len(self.response_rules):
+            doomed = self.response_rules[int(which) - 1]
+        else:
+            matching = [rule for rule in self.response_rules if rule[0].pattern == which]
+            if not matching:
+                return bot.address_msg(user, channel, 'No such rule %r.' % (which,))
+            doomed = matching[0]
+        self.set_rules([rule for rule in self.response_rules if rule is not doomed])
+        bot.service.update_message_filters(self.name())
+        bot.service.mark_plugin_dirty(self.name())
+        return bot.address_msg(user, channel, 'Removed rule %r -> %r.'
+                                              % (doomed[0].pattern, doomed[1].template))
+
+    @require_priv('admin')
+    def command_list_rules(self, bot, user, channel, args):
+        if len(args) != 0:
+            return bot.address_msg(user, channel, 'usage: list-rules')
+        if not self.response_rules:
+            return bot.address_msg(user, channel, 'No response rules.')
+        return bot.address_msg(user, channel, '\n'.join(
+                '%d: %r -> %r' % (n, regex.pattern, response.template)
+                for (n, (regex, response)) in enumerate(self.response_rules, 1)), pack=True)
+
+    @require_priv('admin')
+    def command_rulestats(self, bot, user, channel, args):
+        if len(args) != 0:
+            return bot.address_msg(user, channel, 'usage: rulestats')
+        if not self.rule_stats:
+            return bot.address_msg(user, channel, 'No response rules have been evaluated.')
+        slowest = sorted(self.rule_stats.items(), key=lambda (p, s): -s[1])[:5]
+        return bot.address_msg(user, channel, 'Slowest rules: ' + '; '.join(
+                '%r: %d runs, %.1fms total, %.1fms max' % (p, n, total * 1000, most * 1000)
+                for (p, (n, total, most)) in slowest))
+
+    @require_priv('admin')
+    def command_quarantined(self, bot, user, channel, args):
+        if len(args) != 0:
+            return bot.address_msg(user, channel, 'usage: quarantined')
+        if not self.quarantined:
+            return bot.address_msg(user, channel, 'No response rules are quarantined.')
+        return bot.address_msg(user, channel, '; '.join(
+                '%d: %r (%s)' % (n, pattern, reason)
+                for (n, (pattern, sub, reason)) in enumerate(self.quarantined, 1)))
+
+    @require_priv('admin')
+    def command_release_rule(self, bot, user, channel, args):
+        if len(args) != 1:
+            return bot.address_msg(user, channel, 'usage: release-rule <number|regex>')
+        which = args[0]
+        if which.isdigit() and 1 <= int(which) <= len(self.quarantined):
+            index = int(which) - 1
+        else:
+            matching = [n for (n, q) in enumerate(self.quarantined) if q[0] == which]
+            if not matching:
+                return bot.address_msg(user, channel, 'No quarantined rule %r.' % (which,))
+            index = matching[0]
+        pattern, sub, reason = self.quarantined.pop(index)
+        self.set_rules(self.response_rules + [(re.compile(pattern), ResponseTemplate(sub))])
+        bot.service.update_message_filters(self.name())
+        bot.service.mark_plugin_dirty(self.name())
+        return bot.address_msg(user, channel, 'Released rule %r -> %r as rule %d.'
+                                              % (pattern, sub, len(self.response_rules)))
+
     def privmsg(self, bot, user, channel, msg):
-        for m in self.link_ignore_list:
-            if mask_matches(m, user):
-                return
-        return self.respond(msg, lambda r: bot.address_msg(user, channel, r, prefix=False))
+        if self.link_ignore.matches(user):
+            return
+        return self.respond(bot, msg, lambda r: bot.address_msg(user, channel, r, prefix=False,
+                                                                priority=PRIORITY_PASSIVE))
 
     def action(self, bot, user, channel, msg):
-        for m in self.link_ignore_list:
-            if mask_matches(m, user):
-                return
-        return self.respond(msg, lambda r: bot.address_msg(user, channel, r, prefix=False))
+        if self.link_ignore.matches(user):
+            return
+        return self.respond(bot, msg, lambda r: bot.address_msg(user, channel, r, prefix=False,
+                                                                priority=PRIORITY_PASSIVE))
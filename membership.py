@@ -0,0 +1,224 @@
+# channel membership tracking for cassbot connections
+
+import re
+
+# when servers split, everyone on the far side seems to QUIT with the names
+# of the two servers which lost contact as the message
+netsplit_message = re.compile(r'^([\w*-]+(?:\.[\w*-]+)+) ([\w*-]+(?:\.[\w*-]+)+)$')
+
+def netsplit_servers(message):
+    """
+    If message looks like a netsplit QUIT message, return the two server
+    names in it, otherwise None.
+    """
+    m = netsplit_message.match(message)
+    if m is None or m.group(1) == m.group(2):
+        return None
+    return m.groups()
+
+
+class UserRecord(object):
+    """
+    One nick known to be in at least one of our channels. chanmask has the
+    bit of every channel it's in set (see ChannelRecord.bit).
+    """
+
+    __slots__ = ('nick', 'chanmask')
+
+    def __init__(self, nick):
+        self.nick = nick
+        self.chanmask = 0
+
+
+class ChannelRecord(object):
+    """
+    One of our channels. members maps the UserRecord of each nick in it to
+    a bitmask of that nick's per-user modes in the channel.
+    """
+
+    __slots__ = ('name', 'index', 'bit', 'members')
+
+    def __init__(self, name, index):
+        self.name = name
+        self.index = index
+        self.bit = 1 << index
+        self.members = {}
+
+
+class ChannelMembership:
+    """
+    Which nicks are in which of our channels, and the per-user channel
+    modes (op, voice, ...) each one has there.
+
+    Each nick is stored once, in a UserRecord shared by all its channels,
+    and records the channels it is in as a bitmask over channel slots.
+    Channels map member records to mode bitmasks, so a user in a channel
+    costs one dict entry rather than a string and a set. A part or quit
+    costs as much as the number of channels the nick was in; a nick change
+    only touches the nick table.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        # nick -> UserRecord
+        self.users = {}
+        # channel name -> ChannelRecord
+        self.channels_by_name = {}
+        # ChannelRecord.index -> ChannelRecord, or None for a free slot
+        self.channel_slots = []
+        self.free_slots = []
+        # mode character -> bit, allocated as modes are seen
+        self.mode_bits = {}
+
+    def mode_bit(self, mode):
+        try:
+            return self.mode_bits[mode]
+        except KeyError:
+            bit = self.mode_bits[mode] = 1 << len(self.mode_bits)
+            return bit
+
+    def decode_modes(self, bits):
+        return frozenset(m for (m, b) in self.mode_bits.iteritems() if bits & b)
+
+    def channel_records(self, chanmask):
+        slots = self.channel_slots
+        while chanmask:
+            low = chanmask & -chanmask
+            yield slots[low.bit_length() - 1]
+            chanmask ^= low
+
+    def add_channel(self, channel):
+        """
+        Start tracking channel (normally because we just joined it),
+        forgetting anything already known about it.
+        """
+        self.remove_channel(channel)
+        if self.free_slots:
+            index = self.free_slots.pop()
+        else:
+            index = len(self.channel_slots)
+            self.channel_slots.append(None)
+        chan = self.channel_slots[index] = self.channels_by_name[channel] \
+             = ChannelRecord(channel, index)
+        return chan
+
+    def remove_channel(self, channel):
+        chan = self.channels_by_name.pop(channel, None)
+        if chan is None:
+            return
+        for user in chan.members:
+            self.drop_channel_bit(user, chan.bit)
+        self.channel_slots[chan.index] = None
+        self.free_slots.append(chan.index)
+
+    def drop_channel_bit(self, user, bit):
+        user.chanmask &= ~bit
+        if not user.chanmask:
+            del self.users[user.nick]
+
+    def join(self, nick, channel):
+        chan = self.channels_by_name.get(channel)
+        if chan is None:
+            chan = self.add_channel(channel)
+        user = self.users.get(nick)
+        if user is None:
+            user = self.users[nick] = UserRecord(nick)
+        if not user.chanmask & chan.bit:
+            user.chanmask |= chan.bit
+            chan.members[user] = 0
+
+    def part(self, nick, channel):
+        chan = self.channels_by_name.get(channel)
+        user = self.users.get(nick)
+        if chan is None or user is None or not user.chanmask & chan.bit:
+            return False
+        del chan.members[user]
+        self.drop_channel_bit(user, chan.bit)
+        return True
+
+    def quit(self, nick):
+        """
+        Remove nick from every channel. Returns the channels it was in.
+        """
+        user = self.users.pop(nick, None)
+        if user is None:
+            return []
+        chans = []
+        for chan in self.channel_records(user.chanmask):
+            del chan.members[user]
+            chans.append(chan.name)
+        return chans
+
+    def rename(self, oldnick, newnick):
+        user = self.users.pop(oldnick, None)
+        if user is None:
+            return
+        # anything still recorded under the new nick is stale
+        self.quit(newnick)
+        user.nick = newnick
+        self.users[newnick] = user
+
+    def is_member(self, nick, channel):
+        user = self.users.get(nick)
+        if user is None:
+            return False
+        chan = self.channels_by_name.get(channel)
+        return chan is not None and bool(user.chanmask & chan.bit)
+
+    def nicks(self, channel):
+        chan = self.channels_by_name.get(channel)
+        if chan is None:
+            return []
+        return [user.nick for user in chan.members]
+
+    def channels(self, nick):
+        user = self.users.get(nick)
+        if user is None:
+            return []
+        return [chan.name for chan in self.channel_records(user.chanmask)]
+
+    def set_mode(self, channel, nick, mode, beingset):
+        chan = self.channels_by_name.get(channel)
+        user = self.users.get(nick)
+        if chan is None or user is None or user not in chan.members:
+            return
+        if beingset:
+            chan.members[user] |= self.mode_bit(mode)
+        else:
+            chan.members[user] &= ~self.mode_bit(mode)
+
+    def modes(self, channel, nick):
+        chan = self.channels_by_name.get(channel)
+        user = self.users.get(nick)
+        if chan is None or user is None:
+            return frozenset()
+        return self.decode_modes(chan.members.get(user, 0))
+
+
+class SplitBatch:
+    """
+    The users seen quitting (or rejoining) in one netsplit burst so far,
+    with the channels each one left (or joined), in the order seen.
+    """
+
+    def __init__(self):
+        self.channels_of = {}
+        self.nicks = []
+        self.timer = None
+
+    def add(self, nick, channels):
+        chans = self.channels_of.get(nick)
+        if chans is None:
+            chans = self.channels_of[nick] = []
+            self.nicks.append(nick)
+        chans.extend(channels)
+
+    def users(self):
+        return [(nick, self.channels_of[nick]) for nick in self.nicks]
+
+    def __len__(self):
+        return len(self.nicks)
+
+# vim: set et sw=4 ts=4 :
@@ -0,0 +1,295 @@
+# outbound message scheduling for cassbot connections
+
+from collections import deque
+from twisted.python import log
+
+# lower numbers go out first
+PRIORITY_COMMAND = 0
+PRIORITY_PASSIVE = 1
+
+PACK_SEPARATOR = ' | '
+
+
+def utf8_boundary(text, pos):
+    """
+    Move pos backward, if necessary, so that text[:pos] does not end in the
+    middle of a UTF-8 multibyte sequence.
+    """
+    while pos > 0 and 0x80 <= ord(text[pos]) < 0xc0:
+        pos -= 1
+    return pos
+
+def split_message(text, limit):
+    """
+    Split text into pieces of at most limit bytes, breaking at spaces where
+    possible. Unicode text is UTF-8 encoded first, since it's the encoded
+    size that counts. A limit of None means no limit.
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    if limit is None or len(text) <= limit:
+        return [text]
+    pieces = []
+    while len(text) > limit:
+        cut = text.rfind(' ', 0, limit + 1)
+        if cut > 0:
+            pieces.append(text[:cut])
+            text = text[cut+1:]
+        else:
+            cut = utf8_boundary(text, limit) or limit
+            pieces.append(text[:cut])
+            text = text[cut:]
+    if text:
+        pieces.append(text)
+    return pieces
+
+def pack_lines(lines, limit, sep=PACK_SEPARATOR):
+    """
+    Join consecutive lines with sep, as long as the result fits in limit
+    bytes.
+    """
+    if limit is None:
+        return [sep.join(lines)] if lines else []
+    packed = []
+    for line in lines:
+        if packed and len(packed[-1]) + len(sep) + len(line) <= limit:
+            packed[-1] = packed[-1] + sep + line
+        else:
+            packed.append(line)
+    return packed
+
+
+class TokenBucket:
+    """
+    Allow up to 'burst' actions at once, refilling at 'rate' actions per
+    second.
+    """
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = now
+
+    def refill(self, now):
+        elapsed = now - self.last_refill
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.last_refill = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now):
+        """
+        Seconds from now until a token will be available.
+        """
+        self.refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class OutboundQueue:
+    """
+    Holds outgoing messages for one connection and hands them to sendfunc
+    no faster than the token bucket allows. Messages with a better (lower)
+    priority always go first; within a priority, targets take turns, one
+    message each, so one long reply can't starve replies to other channels.
+
+    When nothing is queued and a token is available, a message is sent
+    right away. Messages which do have to wait, and have one of the
+    pack_priorities, are sent joined together with others to the same
+    target, as long as the result fits in limitfunc(target) bytes.
+    """
+
+    def __init__(self, sendfunc, reactor, rate, burst, limitfunc=None,
+                 pack_priorities=(PRIORITY_PASSIVE,)):
+        self.sendfunc = sendfunc
+        self.reactor = reactor
+        self.limitfunc = limitfunc
+        self.pack_priorities = pack_priorities
+        self.bucket = TokenBucket(rate, burst, reactor.seconds())
+        # priority -> {target: deque of (message, length, time queued)}
+        self.queues = {}
+        # priority -> deque of targets with something queued, in turn order
+        self.rotations = {}
+        self.depth = 0
+        self.wakeup_call = None
+
+        self.sent_count = 0
+        self.delayed_count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.packed_count = 0
+
+    def put(self, target, message, length=None, priority=PRIORITY_COMMAND):
+        targetqueues = self.queues.setdefault(priority, {})
+        q = targetqueues.get(target)
+        if q is None:
+            q = targetqueues[target] = deque()
+            self.rotations.setdefault(priority, deque()).append(target)
+        q.append((message, length, self.reactor.seconds()))
+        self.depth += 1
+        self.flush()
+
+    def pop_next(self):
+        priority = min(p for (p, r) in self.rotations.iteritems() if r)
+        rotation = self.rotations[priority]
+        targetqueues = self.queues[priority]
+        target = rotation.popleft()
+        q = targetqueues[target]
+        message, length, queued_at = q.popleft()
+        self.depth -= 1
+        if q and priority in self.pack_priorities and self.limitfunc is not None:
+            message = self.pack_queued(message, q, self.limitfunc(target))
+        if q:
+            rotation.append(target)
+        else:
+            del targetqueues[target]
+        return target, message, length, queued_at
+
+    def pack_queued(self, message, q, limit):
+        while q:
+            nextmsg = q[0][0]
+            if limit is not None and \
+                    len(message) + len(PACK_SEPARATOR) + len(nextmsg) > limit:
+                break
+            message = message + PACK_SEPARATOR + nextmsg
+            q.popleft()
+            self.depth -= 1
+            self.packed_count += 1
+        return message
+
+    def flush(self):
+        now = self.reactor.seconds()
+        while self.depth and self.bucket.take(now):
+            target, message, length, queued_at = self.pop_next()
+            wait = now - queued_at
+            self.sent_count += 1
+            if wait > 0:
+                self.delayed_count += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                self.sendfunc(target, message, length)
+            except Exception:
+                log.err(None, 'Sending queued message to %s' % (target,))
+        if self.depth and self.wakeup_call is None:
+            self.wakeup_call = self.reactor.callLater(self.bucket.wait_time(now),
+                                                      self.wakeup)
+
+    def wakeup(self):
+        self.wakeup_call = None
+        self.flush()
+
+    def clear(self):
+        """
+        Throw away everything still queued (e.g., when the connection is
+        lost).
+        """
+        if self.wakeup_call is not None:
+            self.wakeup_call.cancel()
+            self.wakeup_call = None
+        self.queues = {}
+        self.rotations = {}
+        self.depth = 0
+
+    def depth_by_priority(self):
+        return dict((priority, sum(len(q) for q in targetqueues.itervalues()))
+                    for (priority, targetqueues) in self.queues.iteritems()
+                    if targetqueues)
+
+    def oldest_wait(self):
+        now = self.reactor.seconds()
+        oldest = [q[0][2] for targetqueues in self.queues.itervalues()
+                          for q in targetqueues.itervalues()]
+        if not oldest:
+            return 0.0
+        return now - min(oldest)
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'depth_by_priority': self.depth_by_priority(),
+            'oldest_wait': self.oldest_wait(),
+            'sent': self.sent_count,
+            'delayed': self.delayed_count,
+            'mean_wait': self.total_wait / self.delayed_count if self.delayed_count else 0.0,
+            'max_wait': self.max_wait,
+            'packed': self.packed_count,
+        }
+
+
+class MoreBuffer:
+    """
+    Remembers the rest of overlong command output, per key (normally a
+    (nick, channel) pair), so it can be handed out a page at a time. An
+    entry expires ttl seconds after it was last touched, and the oldest
+    entries are dropped when the total stored would go over max_bytes.
+    """
+
+    def __init__(self, reactor, ttl=900, max_bytes=256 * 1024):
+        self.reactor = reactor
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # key -> [deque of lines, size in bytes, time last touched]
+        self.entries = {}
+        self.total_bytes = 0
+
+    def store(self, key, lines):
+        """
+        Replace whatever was stored for key with lines. Returns the number
+        of lines kept, which may be fewer than given if they don't all fit.
+        """
+        self.discard(key)
+        self.expire()
+        kept = deque()
+        size = 0
+        for line in lines:
+            if size + len(line) > self.max_bytes:
+                break
+            kept.append(line)
+            size += len(line)
+        if not kept:
+            return 0
+        while self.entries and self.total_bytes + size > self.max_bytes:
+            oldest = min(self.entries, key=lambda k: self.entries[k][2])
+            self.discard(oldest)
+        self.entries[key] = [kept, size, self.reactor.seconds()]
+        self.total_bytes += size
+        return len(kept)
+
+    def take(self, key, count):
+        """
+        Remove and return up to count lines stored for key, along with the
+        number of lines still left after that.
+        """
+        self.expire()
+        entry = self.entries.get(key)
+        if entry is None:
+            return [], 0
+        q = entry[0]
+        lines = [q.popleft() for _ in xrange(min(count, len(q)))]
+        taken = sum(len(line) for line in lines)
+        entry[1] -= taken
+        entry[2] = self.reactor.seconds()
+        self.total_bytes -= taken
+        if not q:
+            del self.entries[key]
+        return lines, len(q)
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+
+    def expire(self):
+        cutoff = self.reactor.seconds() - self.ttl
+        for key, entry in self.entries.items():
+            if entry[2] < cutoff:
+                self.discard(key)
+
+# vim: set et sw=4 ts=4 :
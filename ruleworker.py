@@ -0,0 +1,334 @@
+# runs RegexResponder rules in a separate process, under a time budget
+
+import os
+import re
+import signal
+import sys
+import time
+from collections import deque
+from string import Template
+from twisted.internet import defer, protocol
+from twisted.protocols import basic
+from twisted.python import log
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class ResponseTemplate:
+    """
+    A response template, parsed once into literal text and placeholders, so
+    that filling it in for a match is only a join. Fills in the same way as
+    string.Template.safe_substitute: $name and ${name} are replaced by the
+    named group, $$ by $, and anything else is left as it is.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        # literal strings, and (name, original text) for placeholders
+        self.parts = []
+        literal = []
+        pos = 0
+        for m in Template.pattern.finditer(template):
+            literal.append(template[pos:m.start()])
+            pos = m.end()
+            name = m.group('named') or m.group('braced')
+            if name is not None:
+                self.parts.append(''.join(literal))
+                self.parts.append((name, m.group()))
+                literal = []
+            elif m.group('escaped') is not None:
+                literal.append('$')
+            else:
+                literal.append(m.group())
+        literal.append(template[pos:])
+        self.parts.append(''.join(literal))
+        self.parts = [part for part in self.parts if part != '']
+        self.constant = None
+        if not any(isinstance(part, tuple) for part in self.parts):
+            self.constant = ''.join(self.parts)
+
+    def render(self, groups):
+        if self.constant is not None:
+            return self.constant
+        out = []
+        for part in self.parts:
+            if isinstance(part, tuple):
+                name, text = part
+                if name in groups:
+                    part = '%s' % (groups[name],)
+                else:
+                    part = text
+            out.append(part)
+        return ''.join(out)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.template)
+
+
+class RuleWorker:
+    """
+    Applies response rules to messages in a child process, so that a rule
+    which takes too long on some message (catastrophic backtracking, say)
+    can be stopped without freezing the reactor. The re module holds the
+    GIL for the whole of a match, so a thread wouldn't do.
+
+    engine is a RuleEngine; only its candidate rules for a message are sent
+    to the child, and a message with no candidates never leaves this
+    process. Messages are evaluated one at a time.
+
+    The child holds each rule to budget seconds of its own CPU time, with
+    a timer which kills it if the rule overruns. That can't be set off by
+    anything but the rule itself: not by other rules for the message, nor
+    by this process being slow to read the results. When it happens,
+    on_timeout(rule, message) is called with the (regex, response) rule
+    which was running. If that sets a new engine (without the rule, say),
+    the message is evaluated again from the start with it; otherwise the
+    message gets no responses. If the child
+    doesn't finish a message within stall_timeout seconds for any other
+    reason, it is killed and the message dropped without blaming any rule.
+
+    The child is started when needed, and stopped after idle_timeout
+    seconds without work.
+    """
+
+    max_queue = 200
+    idle_timeout = 300
+    stall_timeout = 30
+
+    def __init__(self, reactor, engine, budget, on_timeout):
+        self.reactor = reactor
+        self.engine = engine
+        self.budget = budget
+        self.on_timeout = on_timeout
+        self.proto = None
+        # (message, Deferred) waiting to be sent
+        self.queue = deque()
+        self.current = None
+        self.current_rule = None
+        self.timer = None
+        self.idle_timer = None
+        self.rules_sent = False
+
+    def set_engine(self, engine):
+        self.engine = engine
+        self.rules_sent = False
+
+    def evaluate(self, msg):
+        """
+        Return a Deferred firing with (responses, [(rule, seconds)]) for
+        msg, where the rules are (regex, response) pairs from the engine the
+        message was evaluated with.
+        """
+        if not self.engine.candidates(msg):
+            return defer.succeed(([], []))
+        if len(self.queue) >= self.max_queue:
+            log.msg('Rule worker queue is full; dropping message')
+            return defer.succeed(([], []))
+        d = defer.Deferred()
+        self.queue.append((msg, d))
+        self.send_next()
+        return d
+
+    def send_next(self):
+        if self.current is not None or not self.queue:
+            return
+        msg, d = self.queue.popleft()
+        indices = self.engine.candidates(msg)
+        if not indices:
+            d.callback(([], []))
+            return self.send_next()
+        self.cancel_timer('idle_timer')
+        if self.proto is None:
+            self.start_process()
+        if not self.rules_sent:
+            self.proto.send(('rules', [(regex.pattern, regex.flags, response.template)
+                                       for (regex, response) in self.engine.rules]))
+            self.rules_sent = True
+        self.current = (msg, d, self.engine)
+        self.current_rule = None
+        self.proto.send(('match', msg, indices))
+        self.timer = self.reactor.callLater(self.stall_timeout, self.stalled)
+
+    def start_process(self):
+        self.proto = RuleWorkerProtocol(self)
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        self.reactor.spawnProcess(self.proto, sys.executable,
+                                  [sys.executable, script, repr(self.budget)],
+                                  env=os.environ)
+        self.rules_sent = False
+
+    def cancel_timer(self, attr):
+        timer = getattr(self, attr)
+        if timer is not None and timer.active():
+            timer.cancel()
+        setattr(self, attr, None)
+
+    def message_received(self, message):
+        kind = message[0]
+        if kind == 'start':
+            self.current_rule = message[1]
+        elif kind == 'done' and self.current is not None:
+            responses, timings = message[1:]
+            rules = self.current[2].rules
+            self.finish((responses, [(rules[i], seconds) for (i, seconds) in timings]))
+
+    def finish(self, result):
+        self.cancel_timer('timer')
+        msg, d, engine = self.current
+        self.current = None
+        d.callback(result)
+        self.send_next()
+        if self.current is None and self.proto is not None:
+            self.cancel_timer('idle_timer')
+            self.idle_timer = self.reactor.callLater(self.idle_timeout, self.stop_process)
+
+    def stalled(self):
+        self.timer = None
+        log.msg('Rule worker took over %ss on a message; restarting it'
+                % (self.stall_timeout,))
+        self.stop_process()
+        self.finish(([], []))
+
+    def process_ended(self, proto, reason):
+        if proto is not self.proto:
+            # one we killed on purpose
+            return
+        self.proto = None
+        if self.current is None:
+            return
+        msg, d, engine = self.current
+        if getattr(reason.value, 'signal', None) == signal.SIGVTALRM \
+                and self.current_rule is not None:
+            # before finishing, so nothing queued in response sees the rule
+            self.on_timeout(engine.rules[self.current_rule], msg)
+            if self.engine is not engine:
+                self.cancel_timer('timer')
+                self.current = None
+                self.queue.appendleft((msg, d))
+                return self.send_next()
+        else:
+            log.msg('Rule worker process ended while evaluating a message: %s'
+                    % (reason.getErrorMessage(),))
+        self.finish(([], []))
+
+    def stop_process(self):
+        proto, self.proto = self.proto, None
+        if proto is not None:
+            try:
+                proto.transport.signalProcess('KILL')
+            except Exception:
+                pass
+
+    def stop(self):
+        """
+        Kill the child, and answer anything still queued with no responses.
+        """
+        self.cancel_timer('timer')
+        self.cancel_timer('idle_timer')
+        self.stop_process()
+        pending = list(self.queue)
+        if self.current is not None:
+            pending.insert(0, self.current[:2])
+        self.queue.clear()
+        self.current = None
+        for msg, d in pending:
+            d.callback(([], []))
+
+
+class FrameReceiver(basic.NetstringReceiver):
+    MAX_LENGTH = 16 * 1024 * 1024
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def stringReceived(self, data):
+        self.callback(pickle.loads(data))
+
+
+class RuleWorkerProtocol(protocol.ProcessProtocol):
+    """
+    Talks to the child: pickles framed as netstrings over its stdin and
+    stdout.
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.receiver = FrameReceiver(worker.message_received)
+
+    def connectionMade(self):
+        self.receiver.makeConnection(self.transport)
+
+    def send(self, message):
+        data = pickle.dumps(message, -1)
+        self.transport.write('%d:%s,' % (len(data), data))
+
+    def outReceived(self, data):
+        # ignore anything still coming from a child we've given up on
+        if self.worker.proto is self:
+            self.receiver.dataReceived(data)
+
+    def errReceived(self, data):
+        log.msg('Rule worker: %s' % (data.rstrip(),))
+
+    def processEnded(self, reason):
+        self.worker.process_ended(self, reason)
+
+
+# the child's side
+
+def read_frame(f):
+    length = ''
+    while True:
+        c = f.read(1)
+        if not c:
+            return None
+        if c == ':':
+            break
+        length += c
+    data = f.read(int(length))
+    f.read(1)
+    return pickle.loads(data)
+
+def write_frame(f, message):
+    data = pickle.dumps(message, -1)
+    f.write('%d:%s,' % (len(data), data))
+    f.flush()
+
+def worker_main(infile, outfile, budget):
+    """
+    Serve requests from the parent until stdin is closed. Each rule gets
+    budget seconds of CPU time per message, enforced by a virtual timer
+    whose SIGVTALRM kills the process (a match can't be interrupted any
+    other way), which the parent takes as the rule's fault.
+    """
+    rules = []
+    while True:
+        message = read_frame(infile)
+        if message is None:
+            return
+        if message[0] == 'rules':
+            rules = [(re.compile(pattern, flags), ResponseTemplate(response))
+                     for (pattern, flags, response) in message[1]]
+        elif message[0] == 'match':
+            msg, indices = message[1:]
+            responses = []
+            timings = []
+            for i in indices:
+                write_frame(outfile, ('start', i))
+                regex, template = rules[i]
+                start = time.time()
+                signal.setitimer(signal.ITIMER_VIRTUAL, budget)
+                for m in regex.finditer(msg):
+                    responses.append(template.render(m.groupdict()))
+                signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+                timings.append((i, time.time() - start))
+            write_frame(outfile, ('done', responses, timings))
+
+if __name__ == '__main__':
+    signal.signal(signal.SIGVTALRM, signal.SIG_DFL)
+    worker_main(sys.stdin, sys.stdout, float(sys.argv[1]))
+
+# vim: set et sw=4 ts=4 :
@@ -0,0 +1,253 @@
+# on-disk persistence for cassbot state
+
+from __future__ import with_statement
+
+import os
+import sqlite3
+import tempfile
+from twisted.python import log
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def atomic_write(path, data):
+    """
+    Replace the file at path with data, such that a crash at any point
+    leaves either the old contents or the new ones there, never a mix.
+    The data goes to a temporary file in the same directory, which is
+    synced to disk and then renamed over the original.
+    """
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmppath = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                                   suffix='.tmp', dir=dirname)
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmppath, path)
+    except:
+        try:
+            os.unlink(tmppath)
+        except OSError:
+            pass
+        raise
+
+
+class StateSection(object):
+    """
+    One plugin's saved state, along with the version of the plugin's state
+    format it was saved in. When unpickled, the state itself stays pickled
+    until decode() is called, so that loading the statefile doesn't cost
+    anything for plugins that are never enabled, and a plugin whose
+    classes have changed can't break loading for the others.
+    """
+
+    __slots__ = ('version', 'blob', 'value', 'decoded')
+
+    def __init__(self, value, version):
+        self.version = version
+        self.blob = None
+        self.value = value
+        self.decoded = True
+
+    def decode(self):
+        if not self.decoded:
+            self.value = pickle.loads(self.blob)
+            self.decoded = True
+        return self.value
+
+    def __getstate__(self):
+        if self.blob is None:
+            self.blob = pickle.dumps(self.value, -1)
+        return (self.version, self.blob)
+
+    def __setstate__(self, state):
+        self.version, self.blob = state
+        self.value = None
+        self.decoded = False
+
+
+class StateJournal:
+    """
+    An append-only file of (key, value) records, each saying that key has
+    been changed to value since the last full snapshot was written. Saving
+    a change costs only the size of the change; replaying the records over
+    the snapshot recovers the current state.
+
+    The first record in the file gives the journal's generation number.
+    A snapshot notes the generation of the journal folded into it, so a
+    journal left behind by a crash just after a snapshot was written can be
+    recognised and ignored.
+    """
+
+    generation_key = '__generation__'
+
+    def __init__(self, path):
+        self.path = path
+
+    def reset(self, generation):
+        """
+        Replace the journal with an empty one of the given generation.
+        """
+        atomic_write(self.path, pickle.dumps((self.generation_key, generation), -1))
+
+    def append(self, records):
+        with open(self.path, 'ab') as f:
+            for record in records:
+                pickle.dump(record, f, -1)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def read(self):
+        """
+        Return the journal's generation and a list of its records. The
+        generation is None if there is no usable journal. A record cut off
+        by a crash in the middle of an append ends the list.
+        """
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return None, []
+        with f:
+            try:
+                key, generation = pickle.load(f)
+            except Exception:
+                return None, []
+            if key != self.generation_key:
+                return None, []
+            records = []
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except EOFError:
+                    break
+                except Exception:
+                    log.msg('Ignoring truncated or corrupt record at the end '
+                            'of journal %s' % (self.path,))
+                    break
+        return generation, records
+
+
+class KeyValueDB:
+    """
+    An embedded sqlite database holding records for any number of
+    namespaces. Use namespace() to get a PluginStore for one of them.
+    Values are pickled.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # autocommit; PluginStore.transaction issues BEGIN/COMMIT itself
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.text_factory = str
+        try:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        except sqlite3.DatabaseError:
+            pass
+        self.conn.execute('CREATE TABLE IF NOT EXISTS kv ('
+                          ' namespace TEXT NOT NULL,'
+                          ' key TEXT NOT NULL,'
+                          ' value BLOB NOT NULL,'
+                          ' PRIMARY KEY (namespace, key))')
+        self.transaction_depth = 0
+
+    def namespace(self, ns):
+        return PluginStore(self, ns)
+
+    def close(self):
+        self.conn.close()
+
+
+class PluginStore:
+    """
+    A persistent key-value store for one plugin, which lets it read and
+    write single records instead of keeping all its state in memory and
+    returning it from saveState. Keys are strings, values anything
+    pickleable.
+
+    Changes are written as they are made. Group several into one atomic
+    change with:
+
+        with self.store.transaction():
+            ...
+    """
+
+    def __init__(self, db, namespace):
+        self.db = db
+        self.namespace = namespace
+
+    def get(self, key, default=None):
+        row = self.db.conn.execute('SELECT value FROM kv WHERE namespace = ? AND key = ?',
+                                   (self.namespace, key)).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(str(row[0]))
+
+    def put(self, key, value):
+        self.db.conn.execute('INSERT OR REPLACE INTO kv (namespace, key, value) VALUES (?, ?, ?)',
+                             (self.namespace, key,
+                              sqlite3.Binary(pickle.dumps(value, -1))))
+
+    def delete(self, key):
+        self.db.conn.execute('DELETE FROM kv WHERE namespace = ? AND key = ?',
+                             (self.namespace, key))
+
+    def scan(self, prefix=''):
+        """
+        Yield (key, value) for every record whose key starts with prefix,
+        in key order.
+        """
+        cursor = self.db.conn.execute('SELECT key, value FROM kv WHERE namespace = ?'
+                                      ' AND key >= ? ORDER BY key',
+                                      (self.namespace, prefix))
+        for key, value in cursor:
+            if not key.startswith(prefix):
+                break
+            yield key, pickle.loads(str(value))
+
+    def clear(self):
+        self.db.conn.execute('DELETE FROM kv WHERE namespace = ?', (self.namespace,))
+
+    def transaction(self):
+        return StoreTransaction(self.db)
+
+
+class StoreTransaction:
+    """
+    Context manager committing everything done inside it at once, or
+    nothing if an exception escapes. Nested transactions become part of
+    the outermost one.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        if self.db.transaction_depth == 0:
+            self.db.conn.execute('BEGIN')
+        self.db.transaction_depth += 1
+        return self
+
+    def __exit__(self, exctype, excvalue, tb):
+        self.db.transaction_depth -= 1
+        if self.db.transaction_depth == 0:
+            if exctype is None:
+                self.db.conn.execute('COMMIT')
+            else:
+                self.db.conn.execute('ROLLBACK')
+        return False
+
+# vim: set et sw=4 ts=4 :
@@ -27,8 +27,7 @@ application = service.Application(nickname)
 bot.setServiceParent(application)
 
 def setup():
-    for modname in shlex.split(os.environ.get('autoload_modules', 'Admin')):
-        bot.enable_plugin_by_name(modname)
+    bot.enable_plugins(shlex.split(os.environ.get('autoload_modules', 'Admin')))
 
     auto_admin = os.environ.get('auto_admin', os.environ['LOGNAME'])
     bot.auth.addPriv(auto_admin, 'admin')
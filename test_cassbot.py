@@ -0,0 +1,37 @@
+# unit tests for the smaller pieces of cassbot. run with: trial test_cassbot
+
+import re
+from twisted.trial import unittest
+
+import cassbot
+
+class MessageFilterTest(unittest.TestCase):
+    def test_literals_and_plain_regexes_combine(self):
+        f = cassbot.MessageFilter(['a.b', re.compile(r'CASSANDRA-\d+')])
+        self.assertEqual(f.regexes, [])
+        self.assertTrue(f.matches('see a.b'))
+        self.assertFalse(f.matches('see axb'))
+        self.assertTrue(f.matches('fixed in CASSANDRA-1234'))
+        self.assertFalse(f.matches('nothing here'))
+
+    def test_groups_kept_apart(self):
+        pat = re.compile(r'(\w)\1')
+        f = cassbot.MessageFilter(['zzz', pat])
+        self.assertEqual(f.regexes, [pat])
+        self.assertTrue(f.matches('look'))
+        self.assertFalse(f.matches('lok'))
+
+    def test_flags_kept_apart(self):
+        pat = re.compile(r'hello', re.I)
+        f = cassbot.MessageFilter(['zzz', pat])
+        self.assertEqual(f.regexes, [pat])
+        self.assertTrue(f.matches('HELLO there'))
+
+    def test_unicode_flag_kept_apart(self):
+        pat = re.compile(r'caf\w\b', re.U)
+        f = cassbot.MessageFilter(['zzz', pat])
+        self.assertEqual(f.regexes, [pat])
+        self.assertTrue(f.matches(u'caf\xe9 '))
+        self.assertFalse(f.matches(u'caf\xe9s '))
+
+# vim: set et sw=4 ts=4 :
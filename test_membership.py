@@ -0,0 +1,208 @@
+# replays channel traffic through CassBotCore and checks the membership
+# tracking. run with: trial test_membership
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+from twisted.trial import unittest
+
+import cassbot
+
+class Recorder(cassbot.BaseBotPlugin):
+    netsplit_user_events = True
+
+    def __init__(self):
+        cassbot.BaseBotPlugin.__init__(self)
+        self.events = []
+
+    def netsplit(self, bot, servers, users):
+        self.events.append(('netsplit', servers, users))
+
+    def netjoin(self, bot, servers, users):
+        self.events.append(('netjoin', servers, users))
+
+    def userQuit(self, bot, user, quitMessage):
+        self.events.append(('userQuit', user))
+
+    def userJoined(self, bot, user, channel):
+        self.events.append(('userJoined', user, channel))
+
+
+class MembershipReplayTest(unittest.TestCase):
+    channels = ['#c%d' % i for i in range(20)]
+    nusers = 300
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.serv = cassbot.CassBotService('tcp:host=localhost:port=6667', nickname='bot',
+                                           statefile=self.mktemp(), reactor=self.clock)
+        self.serv.get_plugin_classes = lambda: [Recorder]
+        self.serv.enable_plugin_by_name(Recorder.name())
+        self.recorder = self.serv.pluginmap[Recorder.name()]
+        self.bot = cassbot.CassBotCore('bot')
+        self.serv.initialize_proto_state(self.bot)
+        self.bot.makeConnection(proto_helpers.StringTransport())
+        self.bot.nickname = 'bot'
+        self.members = {}
+        for chan in self.channels:
+            self.feed(':bot!b@h JOIN %s' % chan)
+            nicks = ['u%d' % i for i in range(self.nusers) if self.in_channel(i, chan)]
+            self.members[chan] = set(['bot'] + nicks)
+            names = ' '.join(('@' if n.endswith('7') else '') + n for n in nicks)
+            self.feed(':srv 353 bot = %s :bot %s' % (chan, names))
+            self.feed(':srv 366 bot %s :End of /NAMES list.' % chan)
+
+    def tearDown(self):
+        self.bot.connectionLost(None)
+        self.serv.close_plugin_stores()
+
+    def in_channel(self, i, chan):
+        return (i + int(chan[2:])) % 3 == 0
+
+    def feed(self, *lines):
+        for line in lines:
+            self.bot.lineReceived(line)
+
+    def assertConsistent(self):
+        """
+        Check that the membership indexes agree with each other, and with
+        what the replay says should be there.
+        """
+        m = self.bot.membership
+        live = [c for c in m.channel_slots if c is not None]
+        self.assertEqual(sorted(c.name for c in live), sorted(m.channels_by_name))
+        self.assertEqual(sorted(m.free_slots),
+                         [i for (i, c) in enumerate(m.channel_slots) if c is None])
+        for chan in live:
+            self.assertIdentical(m.channels_by_name[chan.name], chan)
+            self.assertEqual(chan.bit, 1 << chan.index)
+            for user in chan.members:
+                self.assertIdentical(m.users[user.nick], user)
+                self.assertTrue(user.chanmask & chan.bit)
+        for nick, user in m.users.items():
+            self.assertEqual(user.nick, nick)
+            self.assertNotEqual(user.chanmask, 0)
+            for chan in m.channel_records(user.chanmask):
+                self.assertIn(user, chan.members)
+        for chan, nicks in self.members.items():
+            self.assertEqual(set(m.nicks(chan)), nicks)
+
+    def test_names(self):
+        self.assertConsistent()
+        self.assertEqual(self.bot.membership.modes('#c0', 'u27'), frozenset('o'))
+        self.assertEqual(self.bot.membership.modes('#c0', 'u3'), frozenset())
+
+    def test_netsplit_and_rejoin(self):
+        split = ['u%d' % i for i in range(0, self.nusers, 2)]
+        for nick in split:
+            self.feed(':%s!x@h QUIT :hub.example.net leaf.example.net' % nick)
+        for chan in self.channels:
+            self.members[chan].difference_update(split)
+        self.assertConsistent()
+        for nick in split:
+            self.assertFalse(self.bot.membership.channels(nick))
+
+        self.clock.advance(self.bot.netsplit_window)
+        netsplits = [e for e in self.recorder.events if e[0] == 'netsplit']
+        self.assertEqual(len(netsplits), 1)
+        self.assertEqual(netsplits[0][1], ('hub.example.net', 'leaf.example.net'))
+        self.assertEqual([nick for (nick, chans) in netsplits[0][2]], split)
+        self.assertEqual(len([e for e in self.recorder.events if e[0] == 'userQuit']),
+                         len(split))
+
+        del self.recorder.events[:]
+        for nick in split:
+            i = int(nick[1:])
+            for chan in self.channels:
+                if self.in_channel(i, chan):
+                    self.feed(':%s!x@h JOIN %s' % (nick, chan))
+                    self.members[chan].add(nick)
+        self.assertConsistent()
+        self.clock.advance(self.bot.netsplit_window)
+        netjoins = [e for e in self.recorder.events if e[0] == 'netjoin']
+        self.assertEqual(len(netjoins), 1)
+        self.assertEqual(len(netjoins[0][2]), len(split))
+
+    def test_netjoin_respects_channel_limits(self):
+        self.serv.set_plugin_channels(Recorder.name(), 'userJoined', ['#c0'])
+        split = ['u%d' % i for i in range(0, 30, 3)]
+        for nick in split:
+            self.feed(':%s!x@h QUIT :hub.example.net leaf.example.net' % nick)
+        self.clock.advance(self.bot.netsplit_window)
+        del self.recorder.events[:]
+        for nick in split:
+            for chan in self.channels:
+                if self.in_channel(int(nick[1:]), chan):
+                    self.feed(':%s!x@h JOIN %s' % (nick, chan))
+        self.clock.advance(self.bot.netsplit_window)
+        joins = [e for e in self.recorder.events if e[0] == 'userJoined']
+        self.assertEqual(joins, [('userJoined', nick, '#c0') for nick in split])
+
+    def test_join_after_netjoin_is_plain(self):
+        split = ['u%d' % i for i in range(0, 30, 3)]
+        for nick in split:
+            self.feed(':%s!x@h QUIT :hub.example.net leaf.example.net' % nick)
+        self.clock.advance(self.bot.netsplit_window)
+        for nick in split:
+            self.feed(':%s!x@h JOIN #c0' % nick)
+        self.clock.advance(self.bot.netsplit_window)
+        self.assertEqual(self.bot.split_nicks, {})
+
+        del self.recorder.events[:]
+        for nick in split[:3]:
+            self.feed(':%s!x@h JOIN #c1' % nick)
+        self.clock.advance(self.bot.netsplit_window)
+        self.assertEqual(self.recorder.events,
+                         [('userJoined', nick, '#c1') for nick in split[:3]])
+
+    def test_plain_quit_forgets_split(self):
+        self.feed(':u3!x@h QUIT :hub.example.net leaf.example.net')
+        self.assertIn('u3', self.bot.split_nicks)
+        self.feed(':u3!x@h JOIN #c0', ':u3!x@h QUIT :Leaving')
+        self.assertNotIn('u3', self.bot.split_nicks)
+
+    def test_small_split_is_plain_quits(self):
+        self.feed(':u1!x@h QUIT :hub.example.net leaf.example.net',
+                  ':u2!x@h QUIT :hub.example.net leaf.example.net')
+        for chan in self.channels:
+            self.members[chan].difference_update(['u1', 'u2'])
+        self.clock.advance(self.bot.netsplit_window)
+        self.assertConsistent()
+        self.assertEqual(self.recorder.events, [('userQuit', 'u1'), ('userQuit', 'u2')])
+
+    def test_nick_part_and_leave(self):
+        self.feed(':srv MODE #c0 +o u3')
+        self.feed(':u3!x@h NICK u3x', ':u6!x@h NICK u6x')
+        for nicks in self.members.values():
+            for old, new in (('u3', 'u3x'), ('u6', 'u6x')):
+                if old in nicks:
+                    nicks.discard(old)
+                    nicks.add(new)
+        self.assertConsistent()
+        self.assertEqual(self.bot.membership.modes('#c0', 'u3x'), frozenset('o'))
+        self.assertNotIn('u3', self.bot.membership.users)
+
+        self.feed(':u6x!x@h PART #c0 :bye')
+        self.members['#c0'].discard('u6x')
+        self.assertConsistent()
+        self.assertFalse(self.bot.membership.is_member('u6x', '#c0'))
+
+        self.feed(':bot!b@h PART #c1')
+        del self.members['#c1']
+        self.assertConsistent()
+        self.assertNotIn('#c1', self.bot.membership.channels_by_name)
+
+        # a new channel reuses the freed slot
+        self.feed(':bot!b@h JOIN #new', ':srv 353 bot = #new :bot u1 u2',
+                  ':srv 366 bot #new :End of /NAMES list.')
+        self.members['#new'] = set(['bot', 'u1', 'u2'])
+        self.assertConsistent()
+        self.assertEqual(self.bot.membership.free_slots, [])
+
+    def test_plain_quit(self):
+        self.feed(':u0!x@h QUIT :Leaving')
+        for nicks in self.members.values():
+            nicks.discard('u0')
+        self.assertConsistent()
+        self.assertEqual(self.recorder.events, [('userQuit', 'u0')])
+
+# vim: set et sw=4 ts=4 :
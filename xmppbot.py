@@ -18,6 +18,9 @@ class XMPPCassBotAdapter(cassbot.CassBotCore):
     room a user is in
     """
 
+    outbound_rate = 5
+    outbound_burst = 10
+
     def join(self, channel, key=None):
         if key is not None:
             raise NotImplemented("can't use channel keys through xmpp client")
@@ -25,6 +28,7 @@ class XMPPCassBotAdapter(cassbot.CassBotCore):
 
     def leave(self, channel, reason=None):
         self.join_channels.discard(channel)
+        self.service.mark_dirty(('service', 'channels'))
         return self.factory.leave(channel)
 
     def kick(self, channel, user, reason=None):
@@ -42,7 +46,10 @@ class XMPPCassBotAdapter(cassbot.CassBotCore):
     def say(self, channel, message, length=None):
         return self.msg(channel, message, length=length)
 
-    def msg(self, room_or_user, message, length=None):
+    def line_byte_limit(self, target):
+        return None
+
+    def send_msg_now(self, room_or_user, message, length=None):
         return self.factory.sendmsg(room_or_user, message)
 
     def notice(self, user, message):